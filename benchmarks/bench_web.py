@@ -0,0 +1,146 @@
+"""Benchmarks of the web anomaly detection pipeline.
+
+Times preprocess_requests, RequestAnomalyDetector.fit, predict and kmeans
+over synthetic access logs (see skinfosec.datasets.synthetic) of 10k, 100k
+and 1M lines, and writes the results as JSON.
+
+Usage (from the root of the repository):
+
+    python benchmarks/bench_web.py --output before.json
+    python benchmarks/bench_web.py --sizes 10000 100000 --output after.json
+    python benchmarks/bench_web.py --compare before.json after.json
+
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+import pandas as pd
+import sklearn
+from skinfosec.datasets.synthetic import make_access_log
+from skinfosec.models.anomaly.web.classes import preprocess_requests
+from skinfosec.models.anomaly.web.classes import RequestAnomalyDetector
+
+SIZES = [10000, 100000, 1000000]
+
+def _time(func, repeat):
+    """Runs func repeat times. Returns the timings and the last result."""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = timer()
+        result = func()
+        times.append(timer() - start)
+    return times, result
+
+def _stats(times, n_lines):
+    return {"min": min(times), "median": float(np.median(times)),
+            "max": max(times), "repeat": len(times),
+            "lines_per_second": n_lines / min(times)}
+
+def bench_size(n_lines, repeat, random_state):
+    """Benchmarks every stage over a synthetic log of n_lines."""
+    lines = make_access_log(n_lines, random_state=random_state)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "access_log")
+        with open(path, "w") as log_h:
+            log_h.writelines(lines)
+        del lines
+
+        def parse():
+            with open(path) as log_h:
+                return preprocess_requests(log_h, "Combined")
+        times, X = _time(parse, repeat)
+        results["preprocess_requests"] = _stats(times, n_lines)
+
+    times, ad = _time(lambda: RequestAnomalyDetector(
+        random_state=0, store_predict_results=True).fit(X), repeat)
+    results["fit"] = _stats(times, n_lines)
+    times, _ = _time(lambda: ad.predict(X), repeat)
+    results["predict"] = _stats(times, n_lines)
+    times, _ = _time(ad.kmeans, repeat)
+    results["kmeans"] = _stats(times, n_lines)
+    return results
+
+def _environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit,
+            "date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__, "pandas": pd.__version__,
+            "sklearn": sklearn.__version__}
+
+def compare(old_file, new_file, threshold):
+    """Prints the ratio of the new and old min times of each benchmark.
+    Returns the number of regressions (ratio above 1 + threshold)."""
+    with open(old_file) as old_h, open(new_file) as new_h:
+        old, new = json.load(old_h), json.load(new_h)
+    regressions = 0
+    print("%-22s %10s %10s %10s %8s" % ("benchmark", "lines", "old (s)", "new (s)", "ratio"))
+    for size, stages in sorted(new["results"].items(), key=lambda item: int(item[0])):
+        for stage, stats in stages.items():
+            if stage not in old["results"].get(size, {}):
+                continue
+            old_min = old["results"][size][stage]["min"]
+            ratio = stats["min"] / old_min
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = " REGRESSION"
+                regressions += 1
+            print("%-22s %10s %10.4f %10.4f %8.2f%s" % (stage, size, old_min,
+                                                        stats["min"], ratio, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES,
+                        help="number of log lines of each benchmark")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of each stage (the minimum is compared)")
+    parser.add_argument("--random-state", type=int, default=0,
+                        help="seed of the synthetic logs")
+    parser.add_argument("--output", default="bench_web.json",
+                        help="JSON file for the results")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return 1 if compare(args.compare[0], args.compare[1], args.threshold) else 0
+
+    report = {"environment": _environment(), "random_state": args.random_state,
+              "results": {}}
+    for n_lines in args.sizes:
+        print("Benchmarking %d lines" % n_lines)
+        report["results"][str(n_lines)] = results = bench_size(
+            n_lines, args.repeat, args.random_state)
+        for stage, stats in results.items():
+            print("  %-20s %10.4f s %12.0f lines/s" % (stage, stats["min"],
+                                                       stats["lines_per_second"]))
+    with open(args.output, "w") as output_h:
+        json.dump(report, output_h, indent=2)
+    print("Results written to %s" % args.output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
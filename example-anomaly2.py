@@ -28,7 +28,7 @@ print(anomalies)
 anon_uri_len = anomalies['uri_length']
 print(anomalies.loc[anomalies['uri_length'] == 1])
 start = timer()
-ad.kmeans()
+ad.kmeans(X)
 print(ad.kmeans_labels)
 end = timer()
 print("kmeans elapsed time = ",end - start)
@@ -35,6 +35,7 @@ data = darpa_intrusion.fetch_darpa_intrusion(subset='train_4hour_1998')
 
 X = data[0]
 
+#Typed columns (uint8 flags, uint16 ports and lengths) feed KMeans directly
 X1 = X[['ip_flags_df', 'ip_flags_mf', 'ip_hdr_len', 'ip_len', 'ip_ttl',
         'tcp_dstport', 'tcp_srcport']]
 
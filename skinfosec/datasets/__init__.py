@@ -2,5 +2,7 @@
 Datasets Module
 '''
 
+import skinfosec.datasets.cache
 import skinfosec.datasets.darpa_intrusion
 import skinfosec.datasets.chuvakin_httpd
+import skinfosec.datasets.synthetic
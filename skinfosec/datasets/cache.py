@@ -0,0 +1,192 @@
+"""Columnar on-disk cache for parsed datasets.
+
+Parsing log files or packet captures is much slower than reading back the
+resulting DataFrame, so the fetchers keep the parsed data in
+'~/scikit_infosec_data/cache'. Feather files are used if pyarrow is
+installed: they are memory-mapped when loaded, and numeric columns without
+missing values are views of the file instead of copies. Otherwise numpy .npz
+files are used, which are read into memory.
+
+Each cached DataFrame has a JSON sidecar with the size, mtime and SHA-256 of
+its source files. An entry is valid while size and mtime do not change; if
+they do (e.g. the source was extracted again), the content hash decides.
+
+"""
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow
+    from pyarrow import feather
+except ImportError:
+    feather = None
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file_h:
+        for block in iter(lambda: file_h.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _source_info(sources, previous=None):
+    """Size, mtime and hash of each source. Hashes are taken from previous
+    (the stored metadata) when size and mtime did not change."""
+    previous = {info["path"]: info for info in (previous or [])}
+    result = []
+    for path in sources:
+        stat = os.stat(path)
+        info = {"path": os.path.abspath(path), "size": stat.st_size,
+                "mtime": stat.st_mtime}
+        old = previous.get(info["path"])
+        if old is not None and old["size"] == info["size"] and old["mtime"] == info["mtime"]:
+            info["sha256"] = old["sha256"]
+        else:
+            info["sha256"] = _file_hash(path)
+        result.append(info)
+    return result
+
+def _to_arrays(X):
+    """Encodes the columns of X as numpy arrays for np.savez."""
+    arrays = {}
+    columns = []
+    for i, (name, col) in enumerate(X.items()):
+        key = "c%d" % i
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            kind = "category"
+            arrays[key] = col.cat.codes.to_numpy()
+            arrays[key + "_categories"] = np.asarray(col.cat.categories, dtype=object)
+        elif isinstance(col.dtype, pd.DatetimeTZDtype):
+            kind = "datetime:" + str(col.dt.tz)
+            arrays[key] = col.dt.tz_convert("UTC").dt.tz_localize(None).to_numpy()
+        elif isinstance(col.dtype, pd.api.extensions.ExtensionDtype) and \
+                hasattr(col.dtype, "numpy_dtype"):
+            #Nullable integer/boolean dtypes
+            kind = "masked:" + str(col.dtype)
+            arrays[key] = col.to_numpy(dtype=col.dtype.numpy_dtype, na_value=0)
+            arrays[key + "_mask"] = col.isna().to_numpy()
+        else:
+            kind = "numpy"
+            arrays[key] = col.to_numpy()
+        columns.append([name, kind])
+    return arrays, columns
+
+def _from_arrays(arrays, columns):
+    """Inverse of _to_arrays."""
+    data = {}
+    for i, (name, kind) in enumerate(columns):
+        key = "c%d" % i
+        if kind == "category":
+            data[name] = pd.Categorical.from_codes(arrays[key],
+                                                   arrays[key + "_categories"])
+        elif kind.startswith("datetime:"):
+            data[name] = pd.Series(arrays[key]).dt.tz_localize("UTC").dt.tz_convert(
+                kind[len("datetime:"):])
+        elif kind.startswith("masked:"):
+            data[name] = pd.array(arrays[key], dtype=kind[len("masked:"):])
+            data[name][arrays[key + "_mask"]] = pd.NA
+        else:
+            data[name] = arrays[key]
+    return pd.DataFrame(data, columns=[name for name, kind in columns])
+
+def _write(X, path_base, fmt):
+    """Writes X and returns the format actually used. Files are replaced
+    (not overwritten), so DataFrames mapping the previous ones stay valid."""
+    if fmt == "feather" and feather is None:
+        logging.info("pyarrow is not installed, using npz")
+    elif fmt == "feather":
+        try:
+            #A single record batch: chunked columns are copied when loaded
+            feather.write_feather(X.reset_index(drop=True), path_base + ".feather.tmp",
+                                  compression="uncompressed", chunksize=max(len(X), 1))
+            os.replace(path_base + ".feather.tmp", path_base + ".feather")
+            return fmt
+        except (pyarrow.ArrowException, TypeError, ValueError) as err:
+            #e.g. object columns mixing types
+            logging.info("Cannot store as feather (%s), using npz", err)
+    arrays, columns = _to_arrays(X)
+    with open(path_base + ".npz.tmp", 'wb') as file_h:
+        np.savez(file_h, **arrays)
+    os.replace(path_base + ".npz.tmp", path_base + ".npz")
+    return "npz:" + json.dumps(columns)
+
+def _read(path_base, fmt):
+    if fmt == "feather":
+        table = feather.read_table(path_base + ".feather", memory_map=True)
+        #Zero-copy where Arrow allows it: one block per column, and the
+        #table releases its buffers as they are converted
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+    columns = json.loads(fmt[len("npz:"):])
+    with np.load(path_base + ".npz", allow_pickle=True) as arrays:
+        return _from_arrays(arrays, columns)
+
+def cached_dataframe(sources, key, loader, cache_directory, refresh=False, fmt=None):
+    """Loads a DataFrame from the cache, or builds and caches it.
+
+    Parameters
+    ----------
+    sources : str or list of str
+        Files the DataFrame is computed from. The entry is invalidated when
+        their content changes.
+
+    key : str
+        Name of the entry (it should include any parsing option).
+
+    loader : callable
+        Function without arguments returning the DataFrame.
+
+    cache_directory : str
+        Folder for the cache files.
+
+    refresh : optional, default: False
+        If True, the DataFrame is always rebuilt (and cached again).
+
+    fmt : optional, default: None
+        "feather" or "npz". By default feather if pyarrow is installed
+        (npz is always used without it).
+
+    """
+    if isinstance(sources, str):
+        sources = [sources]
+    if fmt is None:
+        fmt = "feather" if feather is not None else "npz"
+    if not os.path.exists(cache_directory):
+        logging.info("Creating directory: %s", cache_directory)
+        os.makedirs(cache_directory)
+    path_base = os.path.join(cache_directory, key)
+    meta_file = path_base + ".json"
+
+    meta = None
+    if not refresh and os.path.isfile(meta_file):
+        with open(meta_file) as meta_h:
+            meta = json.load(meta_h)
+        if meta["format"] == "feather" and feather is None:
+            logging.info("Cached data needs pyarrow: %s", path_base)
+            meta = None
+    if meta is not None:
+        info = _source_info(sources, meta["sources"])
+        hashes = [source["sha256"] for source in info]
+        if hashes == [source["sha256"] for source in meta["sources"]]:
+            logging.info("Loading cached data: %s", path_base)
+            if info != meta["sources"]:
+                #Same content, new size/mtime
+                meta["sources"] = info
+                with open(meta_file, 'w') as meta_h:
+                    json.dump(meta, meta_h)
+            return _read(path_base, meta["format"])
+        logging.info("Cached data is outdated: %s", path_base)
+    else:
+        info = _source_info(sources)
+
+    X = loader()
+    logging.info("Caching data: %s", path_base)
+    if os.path.isfile(meta_file):
+        os.remove(meta_file)
+    meta = {"sources": info, "format": _write(X, path_base, fmt)}
+    tmp_file = meta_file + ".tmp"
+    with open(tmp_file, 'w') as meta_h:
+        json.dump(meta, meta_h)
+    os.replace(tmp_file, meta_file)
+    return X
@@ -10,71 +10,21 @@ anonymized or modified in any way (just as they came from the logging system)
 import logging
 import os
 import urllib.request
-import tarfile
-import shutil
 from ..models.anomaly.web import classes as anon_web
+from . import cache
 
-def _fetch_extract(chuvakin_directory, final_file_str, tarfile_str):
+def _fetch(tarfile_str):
     url = 'http://log-sharing.dreamhosters.com/hnet-hon-var-log-02282006.tgz'
+    chuvakin_download = urllib.request.URLopener()
+    logging.info("Downloading : %s to %s", url, tarfile_str)
+    chuvakin_download.retrieve(url, tarfile_str)
+    logging.info("Download completed")
     if not os.path.isfile(tarfile_str):
-        chuvakin_download = urllib.request.URLopener()
-        logging.info("Downloading : %s to %s", url, tarfile_str)
-        chuvakin_download.retrieve(url, tarfile_str)
-        logging.info("Download completed")
-
-    #Extracting tar file (httpd log files only)
-    logging.info("Extracting tar file: %s", tarfile_str)
-    with tarfile.open(tarfile_str, "r:gz") as tar:
-        subdir_and_files = [
-            tarinfo for tarinfo in tar.getmembers()
-            if tarinfo.name.startswith("var/log/httpd/access")]
-        tmpdir = chuvakin_directory+"/chuvakin_tmp"
-        if not os.path.exists(tmpdir):
-            logging.info("Creating temp folder: "+tmpdir)
-            os.makedirs(tmpdir)
-        def is_within_directory(directory, target):
-            
-            abs_directory = os.path.abspath(directory)
-            abs_target = os.path.abspath(target)
-        
-            prefix = os.path.commonprefix([abs_directory, abs_target])
-            
-            return prefix == abs_directory
-        
-        def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-        
-            for member in tar.getmembers():
-                member_path = os.path.join(path, member.name)
-                if not is_within_directory(path, member_path):
-                    raise Exception("Attempted Path Traversal in Tar File")
-        
-            tar.extractall(path, members, numeric_owner=numeric_owner) 
-            
-        
-        safe_extract(tar, members=subdir_and_files, path=tmpdir)
-        tar.close()
-
-        #Merge files
-        logging.info("Merging files in one access_log file")
-        with open(final_file_str, 'wb') as final_file_h:
-            for number in range(31, 0, -1):
-                with open(tmpdir+"/var/log/httpd/access_log."+str(number), 'rb') as tmpfile_h:
-                    shutil.copyfileobj(tmpfile_h, final_file_h)
-            with open(tmpdir+"/var/log/httpd/access_log", 'rb') as tmpfile_h:
-                shutil.copyfileobj(tmpfile_h, final_file_h)
-    #deleting temp folder
-    try:
-        logging.info("Deleting temp folder: %s", tmpdir)
-        shutil.rmtree(tmpdir)
-    except OSError:
-        pass
-    logging.info("Deleting tar file: %s", tarfile_str)
-    os.remove(tarfile_str)
-    if not os.path.isfile(final_file_str):
-        raise IOError("Error opening %s", final_file_str)
+        raise IOError("Error opening %s", tarfile_str)
     return True
 
-def fetch_chuvakin_logs(data_home=None, download_if_missing=True):
+def fetch_chuvakin_logs(data_home=None, download_if_missing=True, n_jobs=1,
+                        refresh=False):
     """Fetcher and Loader for Dr. Anton Chuvakin log files. (httpd logs)
 
     Parameters
@@ -87,6 +37,14 @@ def fetch_chuvakin_logs(data_home=None, download_if_missing=True):
         If False, raise a IOError if the data is not locally available instead
         of trying to download the data from the source site.
 
+    n_jobs : optional, default: 1
+        Number of processes used to parse the log file. -1 means using all
+        the CPUs.
+
+    refresh : optional, default: False
+        If True, the log file is parsed again instead of being loaded from
+        the cache in '~/scikit_infosec_data/cache'.
+
     """
     #Data folder checks
     if data_home is None:
@@ -103,17 +61,24 @@ def fetch_chuvakin_logs(data_home=None, download_if_missing=True):
         os.makedirs(chuvakin_directory)
     #End of data folder checks
 
+    #Merged access_log left by previous versions of this fetcher
     final_file_str = chuvakin_directory+"/access_log"
-    if not os.path.isfile(final_file_str):
-        tarfile_str = chuvakin_directory+"/hnet-hon-var-log-02282006.tgz"
-        if not os.path.isfile(tarfile_str) and not download_if_missing:
-            raise IOError("Data is not locally available")
-        else:
-            _fetch_extract(chuvakin_directory, final_file_str, tarfile_str)
-    else:
+    if os.path.isfile(final_file_str):
         logging.info("File exists: %s: ", final_file_str)
+        source, members = final_file_str, "*"
+    else:
+        tarfile_str = chuvakin_directory+"/hnet-hon-var-log-02282006.tgz"
+        if not os.path.isfile(tarfile_str):
+            if not download_if_missing:
+                raise IOError("Data is not locally available")
+            _fetch(tarfile_str)
+        #The httpd logs are read from the archive, without extracting them
+        source, members = tarfile_str, "var/log/httpd/access_log*"
 
-    with open(final_file_str) as data:
-        dataset = anon_web.preprocess_requests(data, log_format='Combined')
+    dataset = cache.cached_dataframe(
+        source, "chuvakin_access_log-Combined",
+        lambda: anon_web.preprocess_requests_parallel(source, log_format='Combined',
+                                                      n_jobs=n_jobs, members=members),
+        base_directory+"/cache", refresh=refresh)
 
     return dataset
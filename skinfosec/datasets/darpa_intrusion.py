@@ -15,6 +15,8 @@ import shutil
 import stat
 import pandas as pd
 from ..models.anomaly.packet_capture import classes as anon_pcap
+from ..models.anomaly.packet_capture import reader as pcap_reader
+from . import cache
 
 def _parse_darpa_list_file(listfile_str):
     result_list = []
@@ -35,25 +37,38 @@ def _check_files(file_list):
     return True
 
 #Match tcpdump and list file
-def _match_dump_list(dumpfile, listfile):
-    #process pcap file
-    dataset = anon_pcap.preprocess_capture(dumpfile)
+def _match_dump_list(dumpfile, listfile, cache_directory, refresh=False):
+    #process pcap file (or load it from the cache), typed columns
+    dataset = cache.cached_dataframe(
+        dumpfile, os.path.basename(dumpfile)+"-capture-typed",
+        lambda: anon_pcap.preprocess_capture(dumpfile), cache_directory, refresh=refresh)
     #process tcpdump.list file
     parsed_list = _parse_darpa_list_file(listfile)
     cols = ["index", "date", "time", "duration", "service_name", "tcp_srcport",
             "tcp_dstport", "ip_src", "ip_dst", "attack_score", "attack_name"]
     parsed_list_df = pd.DataFrame(parsed_list, columns=cols)
-    #Join both lists
+    #Same dtypes as the capture (ports are "-" for non TCP/UDP connections)
     merge_list = ["tcp_srcport", "tcp_dstport", "ip_src", "ip_dst"]
-    merged_df = dataset.merge(parsed_list_df, how='outer', on=merge_list, right_index=True)
+    for col in ["tcp_srcport", "tcp_dstport"]:
+        parsed_list_df[col] = pd.to_numeric(parsed_list_df[col], errors="coerce")
+    parsed_list_df = parsed_list_df.dropna(subset=["tcp_srcport", "tcp_dstport"])
+    for col in merge_list:
+        dtype = dataset[col].dtype
+        if col.startswith("ip_"):
+            parsed_list_df[col] = pcap_reader.ipv4_to_uint32(parsed_list_df[col])
+        parsed_list_df[col] = parsed_list_df[col].astype(dtype)
+    parsed_list_df["attack_score"] = pd.to_numeric(parsed_list_df["attack_score"],
+                                                   errors="coerce")
+    #Join both lists: each packet gets the first connection with its addresses
+    parsed_list_df = parsed_list_df.drop_duplicates(subset=merge_list)
+    merged_df = dataset[merge_list].merge(parsed_list_df, how='left', on=merge_list)
 
     #Extract target data
     target = merged_df[["attack_score", "attack_name"]].copy()
 
     #Clean NaN values
-    target['attack_score'].fillna(0, inplace=True)
-    target['attack_name'].fillna('-', inplace=True)
-    dataset.fillna(0, inplace=True)
+    target['attack_score'] = target['attack_score'].fillna(0)
+    target['attack_name'] = target['attack_name'].fillna('-')
 
     return (dataset, target)
 
@@ -484,7 +499,7 @@ def _download_test_w1_w2_1998(subset, darpa_directory, download_if_missing):
     return (dumpfile_str, listfile_str)
 
 def fetch_darpa_intrusion(subset='sample_1998', data_home=None,
-                          download_if_missing=True):
+                          download_if_missing=True, refresh=False):
     """Loader for the intrusion detection datasets from DARPA. (tcpdump files)
     Parameters
     ----------
@@ -519,6 +534,10 @@ def fetch_darpa_intrusion(subset='sample_1998', data_home=None,
         For testing data, there are 2 weeks available: X = [1 2], from monday
         to friday
 
+    refresh : optional, default: False
+        If True, the capture is parsed again instead of being loaded from the
+        cache in '~/scikit_infosec_data/cache'.
+
 
     """
     #TODO include hash checks for downloaded and extraction extracted files
@@ -575,4 +594,4 @@ def fetch_darpa_intrusion(subset='sample_1998', data_home=None,
     dumpfile = files[0]
     listfile = files[1]
 
-    return _match_dump_list(dumpfile, listfile)
+    return _match_dump_list(dumpfile, listfile, base_directory+"/cache", refresh)
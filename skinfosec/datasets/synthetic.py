@@ -0,0 +1,84 @@
+"""Synthetic datasets.
+
+Deterministic generators for benchmarks and tests, mimicking the logs
+bundled with the package.
+
+"""
+import datetime
+import os
+import re
+import numpy as np
+from sklearn.utils import check_random_state
+from ..models.anomaly.web import classes as anon_web
+
+REFERENCE_ACCESS_LOG = os.path.join(os.path.dirname(anon_web.__file__), "tests",
+                                    "access.log")
+
+#host logname user, timestamp, method, url, rest of the request line, rest
+_COMBINED_REGEX = re.compile(
+    r'^(\S+ \S+ \S+) \[([^\]]+)\] "(\S+) (\S+)((?: [^"]*)?)" (.*)$')
+
+_DIGIT_REGEX = re.compile(r"\d")
+
+def _load_reference(reference):
+    with open(reference, encoding="utf-8", errors="replace") as reference_h:
+        records = [match.groups() for match in map(_COMBINED_REGEX.match, reference_h)
+                   if match is not None]
+    if len(records) == 0:
+        raise ValueError("No Combined log lines in %s" % reference)
+    first = datetime.datetime.strptime(records[0][1], "%d/%b/%Y:%H:%M:%S %z")
+    last = datetime.datetime.strptime(records[-1][1], "%d/%b/%Y:%H:%M:%S %z")
+    return records, first, (last - first).total_seconds() / max(len(records) - 1, 1)
+
+def make_access_log(n_lines, random_state=None, reference=None, novel_fraction=0.25):
+    """Generates an access log in NCSA Combined format.
+
+    Requests (host, user, method, URL, status, size, referer and user agent)
+    are drawn from a reference log, so the distribution of their fields is
+    kept. The digits in the URLs of novel_fraction of the lines are
+    randomized, so the number of distinct URLs grows with the log as in a
+    real one. Timestamps start with the first line of the reference and
+    increase with exponential gaps of the same mean.
+
+    Parameters
+    ----------
+    n_lines : int
+        Number of lines.
+
+    random_state : int, RandomState instance or None, optional (default=None)
+        Seed of the generator (see sklearn.utils.check_random_state).
+
+    reference : optional, default: None
+        Combined log to mimic. By default, the access.log bundled with the
+        web anomaly tests.
+
+    novel_fraction : float, optional (default=0.25)
+        Fraction of the lines with randomized URLs.
+
+    Returns
+    -------
+    List of lines, ending with a newline.
+
+    """
+    rng = check_random_state(random_state)
+    records, start, mean_gap = _load_reference(reference or REFERENCE_ACCESS_LOG)
+    rows = rng.randint(len(records), size=n_lines)
+    novel = rng.rand(n_lines) < novel_fraction
+    seconds = np.cumsum(rng.exponential(mean_gap, size=n_lines)).astype(np.int64)
+    #Formatting each distinct second once
+    offsets, inverse = np.unique(seconds, return_inverse=True)
+    stamps = [(start + datetime.timedelta(seconds=int(offset))).strftime(
+        "%d/%b/%Y:%H:%M:%S %z") for offset in offsets]
+    #Random digits for the novel URLs, read from a random offset of a pool
+    pool = "".join(map(str, rng.randint(10, size=1 << 16)))
+    pool_offsets = rng.randint(len(pool) - 64, size=n_lines)
+
+    lines = []
+    for i, row in enumerate(rows):
+        prefix, _, method, url, version, rest = records[row]
+        if novel[i]:
+            noise = iter(pool[pool_offsets[i]:pool_offsets[i] + 64])
+            url = _DIGIT_REGEX.sub(lambda match: next(noise, match.group()), url)
+        lines.append('%s [%s] "%s %s%s" %s\n' % (prefix, stamps[inverse[i]], method,
+                                                 url, version, rest))
+    return lines
@@ -0,0 +1,87 @@
+"""
+Tests for the on-disk dataset cache.
+"""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from .. import cache
+from ..cache import cached_dataframe
+from ...models.anomaly.web.classes import preprocess_requests
+
+ACCESS_LOG = os.path.join(os.path.dirname(__file__), "..", "..", "models", "anomaly",
+                          "web", "tests", "access.log")
+
+def test_cached_dataframe(tmp_path):
+    """Entries are reused until the content of the source changes
+    """
+    source = str(tmp_path / "access.log")
+    with open(ACCESS_LOG) as f:
+        lines = f.readlines()
+    with open(source, "w") as f:
+        f.writelines(lines[:100])
+    calls = []
+    def loader():
+        calls.append(1)
+        with open(source) as f:
+            return preprocess_requests(f, "Combined", typed=True)
+    for fmt in ("feather", "npz"):
+        directory = str(tmp_path / fmt)
+        X = cached_dataframe(source, "log", loader, directory, fmt=fmt)
+        Y = cached_dataframe(source, "log", loader, directory, fmt=fmt)
+        assert len(calls) == 1
+        pd.testing.assert_frame_equal(Y, X, check_dtype=False)
+        #Same content, new mtime
+        os.utime(source, (0, 0))
+        cached_dataframe(source, "log", loader, directory, fmt=fmt)
+        assert len(calls) == 1
+        cached_dataframe(source, "log", loader, directory, fmt=fmt, refresh=True)
+        assert len(calls) == 2
+        with open(source, "a") as f:
+            f.writelines(lines[100:110])
+        Z = cached_dataframe(source, "log", loader, directory, fmt=fmt)
+        assert len(calls) == 3 and len(Z) == 110
+        del calls[:]
+        with open(source, "w") as f:
+            f.writelines(lines[:100])
+
+def test_cached_dataframe_zero_copy(tmp_path):
+    """Numeric feather columns are views of the file
+    """
+    pyarrow = pytest.importorskip("pyarrow")
+    source = str(tmp_path / "source")
+    with open(source, "w") as f:
+        f.write("data")
+    X = pd.DataFrame({"a": np.arange(100000), "b": np.random.rand(100000)})
+    directory = str(tmp_path / "cache")
+    cached_dataframe(source, "numbers", lambda: X, directory)
+    before = pyarrow.total_allocated_bytes()
+    Y = cached_dataframe(source, "numbers", lambda: X, directory)
+    assert pyarrow.total_allocated_bytes() - before < X.memory_usage().sum() / 10
+    assert not Y["a"].to_numpy().flags.owndata
+    pd.testing.assert_frame_equal(Y, X)
+    #Refreshing replaces the file mapped by Y
+    cached_dataframe(source, "numbers", lambda: X + 1, directory, refresh=True)
+    pd.testing.assert_frame_equal(Y, X)
+
+def test_cached_dataframe_without_pyarrow(tmp_path, monkeypatch):
+    """npz files are used (and feather entries rebuilt) without pyarrow
+    """
+    source = str(tmp_path / "source")
+    with open(source, "w") as f:
+        f.write("data")
+    X = pd.DataFrame({"a": np.arange(10), "b": list("abcdefghij")})
+    directory = str(tmp_path / "cache")
+    calls = []
+    def loader():
+        calls.append(1)
+        return X
+    with_pyarrow = cache.feather is not None
+    if with_pyarrow:
+        cached_dataframe(source, "data", loader, directory, fmt="feather")
+    monkeypatch.setattr(cache, "feather", None)
+    Y = cached_dataframe(source, "data", loader, directory, fmt="feather")
+    Y = cached_dataframe(source, "data", loader, directory, fmt="feather")
+    assert os.path.isfile(os.path.join(directory, "data.npz"))
+    assert len(calls) == (2 if with_pyarrow else 1)
+    pd.testing.assert_frame_equal(Y, X, check_dtype=False)
@@ -0,0 +1,27 @@
+"""
+Tests for the DARPA datasets.
+"""
+import numpy as np
+from ..darpa_intrusion import _match_dump_list
+from ...models.anomaly.packet_capture.tests.test_capture_reader import _frames, write_pcap
+
+LIST_FILE = """1 01/23/1998 16:56:12 00:00:01 http 1754 80 192.168.001.030 010.000.000.001 0 -
+2 01/23/1998 16:56:13 00:00:01 eco/i - - 010.000.000.001 192.168.001.030 0 -
+3 01/23/1998 16:56:14 00:00:08 telnet 23 40000 172.016.000.001 172.016.000.002 1 guess
+"""
+
+def test_match_dump_list(tmp_path):
+    """Packets are labeled with the connections of the list file
+    """
+    dumpfile = str(tmp_path / "sample.tcpdump")
+    listfile = tmp_path / "sample.tcpdump.list"
+    write_pcap(dumpfile, [frame for frame, _ in _frames()], range(6))
+    listfile.write_text(LIST_FILE)
+    dataset, target = _match_dump_list(dumpfile, str(listfile), str(tmp_path / "cache"))
+    assert dataset.tcp_srcport.dtype == np.uint16 and dataset.ip_src.dtype == np.uint32
+    assert len(target) == len(dataset) == 3
+    assert list(target.attack_score) == [0, 0, 1]
+    assert list(target.attack_name) == ["-", "-", "guess"]
+    #Loaded from the cache
+    cached, _ = _match_dump_list(dumpfile, str(listfile), str(tmp_path / "cache"))
+    assert cached.equals(dataset)
@@ -0,0 +1,19 @@
+"""
+Tests for the synthetic datasets.
+"""
+from ..synthetic import make_access_log
+from ...models.anomaly.web.classes import preprocess_requests
+
+def test_make_access_log():
+    """Synthetic logs are deterministic, parseable and keep the reference fields
+    """
+    lines = make_access_log(2000, random_state=0)
+    assert lines == make_access_log(2000, random_state=0)
+    assert lines != make_access_log(2000, random_state=1)
+    X = preprocess_requests(lines, "Combined")
+    assert len(X) == 2000
+    assert X.time_received_tz_datetimeobj.is_monotonic_increasing
+    assert set(X.request_method) <= {"GET", "HEAD", "PUT", "DELETE", "OPTIONS", "POST"}
+    #Novel URLs make the number of distinct URLs grow with the log
+    Y = preprocess_requests(make_access_log(20000, random_state=0), "Combined")
+    assert Y.request_url.nunique() > 2 * X.request_url.nunique()
@@ -1,9 +1,167 @@
 """
 Base Module for Anomay Detector Classes
 """
+import tracemalloc
+from contextlib import nullcontext
 from datetime import datetime
+from timeit import default_timer as timer
+
+class _Stage(object):
+    """Context manager measuring one run of a stage. rows can be set inside
+    the with block when it is not known in advance."""
+    __slots__ = ("profiler", "name", "rows", "start", "start_memory", "max_peak")
+
+    def __init__(self, profiler, name, rows):
+        self.profiler = profiler
+        self.name = name
+        self.rows = rows
+        self.max_peak = 0
+
+    def __enter__(self):
+        stack = self.profiler._stack
+        if self.profiler.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].max_peak = max(stack[-1].max_peak, peak)
+            tracemalloc.reset_peak()
+            self.start_memory = current
+        stack.append(self)
+        self.start = timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_time = timer() - self.start
+        stack = self.profiler._stack
+        stack.pop()
+        peak_memory = None
+        if self.profiler.trace_memory:
+            peak = max(self.max_peak, tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1].max_peak = max(stack[-1].max_peak, peak)
+            peak_memory = peak - self.start_memory
+        self.profiler._record(self.name, self.rows, wall_time, peak_memory)
+        return False
+
+class StageProfiler(object):
+    """Records wall time, rows and peak memory of named stages.
+
+    Parameters
+    ----------
+    trace_memory: bool, default: False
+        Whether to measure the peak memory of each stage with tracemalloc
+        (which slows down allocations).
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.callbacks = []
+        self.stages = {}
+        self._stack = []
+        self._started_tracing = False
+
+    def stage(self, name, rows=0):
+        """ Context manager measuring a run of the stage name over rows rows.
+        """
+        return _Stage(self, name, rows)
+
+    def add_callback(self, callback):
+        """ Registers callback(record), called at the end of each run of a
+        stage with a dict with its stage, rows, wall_time and peak_memory
+        (bytes allocated above the memory in use at its start, or None).
+        """
+        self.callbacks.append(callback)
+
+    def _record(self, name, rows, wall_time, peak_memory):
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = {"calls": 0, "rows": 0, "wall_time": 0.0,
+                                         "peak_memory": None}
+        stats["calls"] += 1
+        stats["rows"] += rows
+        stats["wall_time"] += wall_time
+        if peak_memory is not None:
+            stats["peak_memory"] = max(stats["peak_memory"] or 0, peak_memory)
+        if self.callbacks:
+            record = {"stage": name, "rows": rows, "wall_time": wall_time,
+                      "peak_memory": peak_memory}
+            for callback in self.callbacks:
+                callback(record)
+
+    def summary(self):
+        """ Returns a dict from stage name to its calls, rows, wall_time
+        (seconds, accumulated), rows_per_second and peak_memory (bytes).
+        """
+        result = {}
+        for name, stats in self.stages.items():
+            result[name] = dict(stats)
+            result[name]["rows_per_second"] = (stats["rows"] / stats["wall_time"]
+                                               if stats["wall_time"] > 0 else None)
+        return result
+
+    def reset(self):
+        """ Forgets the recorded stages (callbacks are kept).
+        """
+        self.stages = {}
+
+class _NullProfiler(object):
+    """Profiler used while profiling is disabled: stages do nothing."""
+    _context = nullcontext(_Stage(None, None, 0))
+
+    def stage(self, name, rows=0):
+        return self._context
+
+NULL_PROFILER = _NullProfiler()
 
 class BaseAnomalyDetector(object):
     """Base Class for Anomay Detector Classes"""
+    #Set by enable_profiling
+    profiler_ = None
+
     def __init__(self):
         self.date_created = datetime.now()
+
+    def enable_profiling(self, trace_memory=False):
+        """ Starts recording the stages of the detector (see StageProfiler).
+        Returns the profiler.
+        """
+        self.disable_profiling()
+        self.profiler_ = StageProfiler(trace_memory=trace_memory)
+        #Only stopping tracemalloc on disable if it is started here
+        self.profiler_._started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if self.profiler_._started_tracing:
+            tracemalloc.start()
+        return self.profiler_
+
+    def disable_profiling(self):
+        """ Stops recording stages. Returns the summary of the recorded ones.
+        """
+        summary = self.profile_summary()
+        if self.profiler_ is not None and self.profiler_._started_tracing:
+            tracemalloc.stop()
+        self.profiler_ = None
+        return summary
+
+    def add_profile_callback(self, callback):
+        """ Registers a callback of the profiler (see StageProfiler.add_callback).
+        """
+        if self.profiler_ is None:
+            raise ValueError("Profiling is disabled, call enable_profiling first")
+        self.profiler_.add_callback(callback)
+
+    def profile_stage(self, name, rows=0):
+        """ Context manager recording a stage when profiling is enabled, e.g.
+        to add the parsing of the data:
+
+            with detector.profile_stage("parse") as stage:
+                X = preprocess_requests(data, "Combined")
+                stage.rows = len(X)
+        """
+        return (self.profiler_ or NULL_PROFILER).stage(name, rows)
+
+    def profile_summary(self):
+        """ Returns StageProfiler.summary(), or an empty dict if profiling is
+        disabled.
+        """
+        if self.profiler_ is None:
+            return {}
+        return self.profiler_.summary()
@@ -2,21 +2,38 @@
 Classes and functions for anomaly detection over captured network traffic.
 """
 import logging
+import numpy as np
 from sklearn.base import BaseEstimator, ClusterMixin
 import pandas as pd
 from apache_log_parser import make_parser
-import pyshark
+try:
+    import pyshark
+except ImportError:
+    pyshark = None
 from ..base import BaseAnomalyDetector
+from . import reader
 
-def preprocess_capture(data, ip_version=4, transp_layer="TCP"):
+def preprocess_capture(data, ip_version=4, transp_layer="TCP", engine="native",
+                       typed=True):
     """Parsess packet capture files (pcap or pcap-ng).
 
     Args:
         data: File path for capture file.
-        log_format: Either "CLF" or "Combined".
+        ip_version: Only 4 (IPv4) is supported.
+        transp_layer: Only "TCP" is supported.
+        engine: Either "native" (default), which memory-maps the file and
+            decodes the Ethernet/IPv4/TCP headers directly, or "pyshark",
+            which dissects the packets with tshark (optional dependency).
+        typed: If True (default), the columns are reader.TYPED_COLUMNS with
+            the dtypes of reader.HEADER_DTYPE: the capture time in seconds
+            (float64), IPs as uint32 (see reader.uint32_to_ipv4), ports and
+            lengths as uint16 and flags as uint8 (0 or 1), ready for sklearn.
+            With the native engine they are a zero-copy view of the decoded
+            headers. If False, the columns are reader.COLUMNS with the strings
+            returned by pyshark.
 
     Returns:
-        pandas.DataFrame with the parsed data.
+        pandas.DataFrame with the parsed data: one row per IPv4 TCP packet.
 
     """
     #SEE: https://www.winpcap.org/ntar/draft/PCAP-DumpFileFormat.html
@@ -32,21 +49,27 @@ def preprocess_capture(data, ip_version=4, transp_layer="TCP"):
     else:
         raise ValueError('transport layer must be TCP')
 
+    if engine == "native":
+        return _preprocess_capture_native(data, typed)
+    elif engine != "pyshark":
+        raise ValueError("engine must be native or pyshark")
+    if pyshark is None:
+        raise ImportError("The pyshark engine requires pyshark (and tshark)")
+
     try:
         capt = pyshark.FileCapture(data, keep_packets=False, display_filter='tcp')
     except:
         exit("Could not open pcap file")
 
-    ip_fields = ['src', 'dst', 'flags_df', 'flags_mf', 'hdr_len', 'len', 'ttl']
-    tcp_fields = ['srcport', 'dstport', 'flags_ack', 'flags_fin', 'flags_push',
-                  'flags_reset', 'flags_syn', 'flags_urg', 'hdr_len', 'len']
+    ip_fields = reader.IP_FIELDS
+    tcp_fields = reader.TCP_FIELDS
 
     #Temporary list to feed the final DataFrame (Performance)
     tmp = []
     counter = 0
     logging.info("Starting packet processing")
     for pkt in capt:
-        filtered = {}
+        filtered = {"timestamp": float(pkt.sniff_timestamp)}
         #First field is a empty string (ignoring)
         if hasattr(pkt, 'ip'):
             for field in ip_fields:
@@ -66,6 +89,71 @@ def preprocess_capture(data, ip_version=4, transp_layer="TCP"):
             logging.info("Processed %d packets", counter)
     logging.info("Ended packet processing")
     logging.info("Converting list to DataFrame")
-    X = pd.DataFrame(tmp)
+    X = pd.DataFrame(tmp, columns=reader.TYPED_COLUMNS)
     logging.info("Ended list conversion")
-    return X
+    if typed:
+        return _typed_pyshark_frame(X)
+    return X[reader.COLUMNS]
+
+def iter_capture(data, chunk_size=100000, chunk_seconds=None, start=0, as_frame=True):
+    """Parses a packet capture file (pcap or pcap-ng) in chunks, with the
+    native reader. Only one chunk of headers is in memory at a time, the file
+    itself is memory-mapped.
+
+    Args:
+        data: File path for capture file.
+        chunk_size: Maximum number of packet records (of any protocol) of a
+            chunk, or None to chunk only by time.
+        chunk_seconds: If given, chunks also end before the first packet
+            captured chunk_seconds or more after their first packet.
+        start: Byte offset to resume from: the offset of a chunk given by a
+            previous iteration (0 reads the whole file).
+        as_frame: If True (default), chunks are DataFrames with the typed
+            columns of preprocess_capture. Otherwise, arrays with
+            reader.HEADER_DTYPE.
+
+    Yields:
+        Tuples (offset, chunk): byte offset of the first record of the chunk
+        and its IPv4 TCP packets (possibly none).
+
+    """
+    with reader.map_capture(data) as buf:
+        counter = 0
+        for records in reader.iter_record_chunks(buf, chunk_size, chunk_seconds, start):
+            headers, _ = reader.decode_tcp_headers(buf, records)
+            counter += len(records)
+            logging.info("Processed %d packets", counter)
+            yield (int(records["record_offset"][0]),
+                   reader.headers_frame(headers) if as_frame else headers)
+
+def _typed_pyshark_frame(X):
+    """Converts the strings returned by pyshark to the typed columns."""
+    result = pd.DataFrame({"timestamp": X["timestamp"].to_numpy(dtype=np.float64)})
+    for col in reader.COLUMNS:
+        dtype = reader.HEADER_DTYPE[col]
+        if col in ("ip_src", "ip_dst"):
+            result[col] = reader.ipv4_to_uint32(X[col])
+        elif "_flags_" in col:
+            #"1" or "True" depending on the version of tshark
+            result[col] = X[col].isin(["1", "True", "true"]).to_numpy(dtype=dtype)
+        else:
+            result[col] = pd.to_numeric(X[col]).fillna(0).to_numpy(dtype=dtype)
+    return result
+
+def _preprocess_capture_native(data, typed):
+    """preprocess_capture with the native reader."""
+    logging.info("Starting packet processing")
+    with reader.map_capture(data) as buf:
+        records = reader.scan_records(buf)
+        logging.info("Found %d packet records", len(records))
+        headers, _ = reader.decode_tcp_headers(buf, records)
+    logging.info("Ended packet processing: %d TCP packets", len(headers))
+    X = reader.headers_frame(headers)
+    if typed:
+        return X
+    #Values as formatted by pyshark
+    result = pd.DataFrame({col: reader.uint32_to_ipv4(X[col].to_numpy())
+                           for col in ["ip_src", "ip_dst"]})
+    for col in reader.COLUMNS[2:]:
+        result[col] = X[col].to_numpy().astype(str)
+    return result
@@ -0,0 +1,226 @@
+"""
+Assembly of TCP packets into bidirectional flows (connections).
+
+Packets are looked up in a hash table by their canonical 5-tuple, so both
+directions of a connection update the same flow. Flows are kept in order of
+last activity and evicted when idle for idle_timeout seconds, when their
+next packet arrives after active_timeout seconds of duration, or when the
+table holds max_flows flows. Only active flows are kept in memory: finished
+ones are returned by each update.
+"""
+import logging
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from . import reader
+from .classes import iter_capture
+
+#Columns of the flow DataFrames. The source of a flow is the endpoint that
+#sent its first packet (fwd: from the source, bwd: to the source). Bytes are
+#the IP lengths of the packets, iat the inter-arrival times in seconds.
+FLOW_DTYPE = np.dtype([
+    ("start", "f8"), ("end", "f8"), ("duration", "f8"),
+    ("ip_src", "u4"), ("tcp_srcport", "u2"), ("ip_dst", "u4"), ("tcp_dstport", "u2"),
+    ("ip_proto", "u1"), ("packets", "u8"), ("bytes", "u8"),
+    ("fwd_packets", "u8"), ("fwd_bytes", "u8"), ("bwd_packets", "u8"),
+    ("bwd_bytes", "u8"), ("syn_count", "u8"), ("fin_count", "u8"),
+    ("reset_count", "u8"), ("push_count", "u8"), ("ack_count", "u8"),
+    ("urg_count", "u8"), ("iat_mean", "f8"), ("iat_std", "f8"), ("iat_min", "f8"),
+    ("iat_max", "f8")])
+FLOW_COLUMNS = list(FLOW_DTYPE.names) + ["end_reason"]
+#Why flows are evicted
+END_REASONS = ["idle", "active", "capacity", "flush"]
+
+#Positions in the state list of a flow
+_START, _LAST, _SRC, _SPORT, _DST, _DPORT, _PACKETS, _BYTES, _FWD_PACKETS, \
+    _FWD_BYTES, _SYN, _FIN, _RESET, _PUSH, _ACK, _URG, _IAT_MEAN, _IAT_M2, \
+    _IAT_MIN, _IAT_MAX = range(20)
+_FLAG_COLUMNS = ["tcp_flags_syn", "tcp_flags_fin", "tcp_flags_reset",
+                 "tcp_flags_push", "tcp_flags_ack", "tcp_flags_urg"]
+
+class FlowTable(object):
+    """Incremental table of the bidirectional TCP flows of a capture.
+
+    Parameters
+    ----------
+    idle_timeout: float, default: 120.0
+        Seconds without packets after which a flow ends.
+
+    active_timeout: float, default: 1800.0
+        Maximum duration of a flow: a packet arriving later starts a new one.
+
+    max_flows: int, optional (default=None)
+        If given, the least recently active flow is evicted when a new one
+        would exceed this number of active flows.
+
+    Attributes
+    ----------
+    flows_: OrderedDict
+        Active flows by canonical 5-tuple, from least to most recently
+        active.
+
+    now_: float
+        Latest packet time seen (captures are not always in time order).
+
+    """
+
+    def __init__(self, idle_timeout=120.0, active_timeout=1800.0, max_flows=None):
+        if idle_timeout <= 0 or active_timeout <= 0:
+            raise ValueError("Timeouts must be positive")
+        if max_flows is not None and max_flows < 1:
+            raise ValueError("max_flows must be at least 1")
+        self.idle_timeout = idle_timeout
+        self.active_timeout = active_timeout
+        self.max_flows = max_flows
+        self.flows_ = OrderedDict()
+        self.now_ = -np.inf
+
+    def __len__(self):
+        return len(self.flows_)
+
+    def update(self, X):
+        """ Adds packets to their flows.
+
+        Args:
+            X: Packets in capture order, a DataFrame (or structured array)
+                with the typed columns of preprocess_capture.
+
+        Returns:
+            DataFrame (see flows_frame) with the flows evicted by the
+            packets.
+
+        """
+        flows = self.flows_
+        ended = []
+        idle_timeout = self.idle_timeout
+        active_timeout = self.active_timeout
+        max_flows = self.max_flows or np.inf
+        now = self.now_
+        columns = [np.asarray(X[col]).tolist() for col in
+                   ["timestamp", "ip_src", "tcp_srcport", "ip_dst", "tcp_dstport",
+                    "ip_len"] + _FLAG_COLUMNS]
+        for time, src, sport, dst, dport, size, syn, fin, rst, psh, ack, urg in zip(*columns):
+            #Canonical 5-tuple: lower endpoint first (TCP only)
+            if (src, sport) <= (dst, dport):
+                key = (src, sport, dst, dport, 6)
+            else:
+                key = (dst, dport, src, sport, 6)
+            flow = flows.get(key)
+            if flow is not None:
+                #Same 5-tuple, but a new connection if the flow timed out
+                if time - flow[_LAST] > idle_timeout:
+                    reason = "idle"
+                elif time - flow[_START] > active_timeout:
+                    reason = "active"
+                else:
+                    reason = None
+                if reason is not None:
+                    del flows[key]
+                    ended.append((flow, reason))
+                    flow = None
+            if flow is None:
+                if len(flows) >= max_flows:
+                    ended.append((flows.popitem(last=False)[1], "capacity"))
+                flows[key] = [time, time, src, sport, dst, dport, 1, size, 1, size,
+                              syn, fin, rst, psh, ack, urg, 0.0, 0.0, np.inf, 0.0]
+            else:
+                flows.move_to_end(key)
+                #Welford's update of the inter-arrival statistics
+                iat = max(time - flow[_LAST], 0.0)
+                flow[_LAST] = max(time, flow[_LAST])
+                flow[_PACKETS] += 1
+                delta = iat - flow[_IAT_MEAN]
+                flow[_IAT_MEAN] += delta / (flow[_PACKETS] - 1)
+                flow[_IAT_M2] += delta * (iat - flow[_IAT_MEAN])
+                if iat < flow[_IAT_MIN]:
+                    flow[_IAT_MIN] = iat
+                if iat > flow[_IAT_MAX]:
+                    flow[_IAT_MAX] = iat
+                flow[_BYTES] += size
+                if src == flow[_SRC] and sport == flow[_SPORT]:
+                    flow[_FWD_PACKETS] += 1
+                    flow[_FWD_BYTES] += size
+                flow[_SYN] += syn
+                flow[_FIN] += fin
+                flow[_RESET] += rst
+                flow[_PUSH] += psh
+                flow[_ACK] += ack
+                flow[_URG] += urg
+            if time > now:
+                now = time
+                #Least recently active flows first
+                while flows:
+                    oldest = next(iter(flows.values()))
+                    if now - oldest[_LAST] <= idle_timeout:
+                        break
+                    ended.append((flows.popitem(last=False)[1], "idle"))
+        self.now_ = now
+        return flows_frame(ended)
+
+    def expire(self, now=None):
+        """ Evicts the flows idle at time now (by default, the latest packet
+        time). Returns them as a DataFrame.
+        """
+        now = self.now_ if now is None else now
+        ended = []
+        for key in [key for key, flow in self.flows_.items()
+                    if now - flow[_LAST] > self.idle_timeout]:
+            ended.append((self.flows_.pop(key), "idle"))
+        return flows_frame(ended)
+
+    def flush(self):
+        """ Evicts every active flow (e.g. at the end of a capture). Returns
+        them as a DataFrame.
+        """
+        ended = [(flow, "flush") for flow in self.flows_.values()]
+        self.flows_ = OrderedDict()
+        return flows_frame(ended)
+
+def flows_frame(ended):
+    """DataFrame with FLOW_COLUMNS of a list of (flow state, end reason)."""
+    result = np.zeros(len(ended), dtype=FLOW_DTYPE)
+    if ended:
+        state = np.array([flow for flow, _ in ended], dtype=np.float64)
+        for name, pos in [("start", _START), ("end", _LAST), ("ip_src", _SRC),
+                          ("tcp_srcport", _SPORT), ("ip_dst", _DST),
+                          ("tcp_dstport", _DPORT), ("packets", _PACKETS),
+                          ("bytes", _BYTES), ("fwd_packets", _FWD_PACKETS),
+                          ("fwd_bytes", _FWD_BYTES), ("syn_count", _SYN),
+                          ("fin_count", _FIN), ("reset_count", _RESET),
+                          ("push_count", _PUSH), ("ack_count", _ACK),
+                          ("urg_count", _URG), ("iat_mean", _IAT_MEAN),
+                          ("iat_max", _IAT_MAX)]:
+            result[name] = state[:, pos]
+        result["duration"] = result["end"] - result["start"]
+        result["ip_proto"] = 6
+        result["bwd_packets"] = result["packets"] - result["fwd_packets"]
+        result["bwd_bytes"] = result["bytes"] - result["fwd_bytes"]
+        #Single packet flows have no inter-arrival times
+        gaps = np.maximum(state[:, _PACKETS] - 1, 1)
+        result["iat_std"] = np.sqrt(state[:, _IAT_M2] / gaps)
+        result["iat_min"] = np.where(state[:, _PACKETS] > 1, state[:, _IAT_MIN], 0.0)
+    X = reader.headers_frame(result)
+    X["end_reason"] = pd.Categorical([reason for _, reason in ended],
+                                     categories=END_REASONS)
+    return X
+
+def preprocess_flows(data, idle_timeout=120.0, active_timeout=1800.0, max_flows=None,
+                     chunk_size=100000):
+    """Assembles the TCP flows of a packet capture file.
+
+    Args:
+        data: File path for capture file (pcap or pcap-ng).
+        idle_timeout, active_timeout, max_flows: See FlowTable.
+        chunk_size: Packets decoded at a time (see iter_capture).
+
+    Returns:
+        pandas.DataFrame with one row per flow and the columns FLOW_COLUMNS,
+        in order of end.
+
+    """
+    table = FlowTable(idle_timeout, active_timeout, max_flows)
+    logging.info("Assembling flows")
+    result = [table.update(X) for _, X in iter_capture(data, chunk_size)]
+    result = pd.concat(result + [table.flush()], ignore_index=True)
+    logging.info("Ended flow assembly: %d flows", len(result))
+    return result
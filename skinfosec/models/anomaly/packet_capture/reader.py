@@ -0,0 +1,365 @@
+"""
+Native reader for packet capture files (pcap and pcap-ng).
+
+Files are memory-mapped and their record headers scanned into an array of
+offsets, without copying the packets. The IPv4 and TCP headers of all the
+packets are then gathered with fancy indexing and decoded with vectorized
+bit operations. Ethernet (with VLAN tags), Linux cooked, BSD loopback and
+raw IP link layers are supported.
+"""
+import mmap
+import struct
+from contextlib import contextmanager
+from itertools import islice
+import numpy as np
+import pandas as pd
+
+#Classic pcap magic numbers: byte order and timestamp resolution
+_PCAP_MAGIC = {b"\xd4\xc3\xb2\xa1": ("<", 1e-6), b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+               b"\x4d\x3c\xb2\xa1": ("<", 1e-9), b"\xa1\xb2\x3c\x4d": (">", 1e-9)}
+_PCAPNG_SHB = b"\x0a\x0d\x0d\x0a"
+_SHB_TYPE = 0x0a0d0d0a
+_PCAPNG_BYTE_ORDER = {b"\x4d\x3c\x2b\x1a": "<", b"\x1a\x2b\x3c\x4d": ">"}
+#pcap-ng block types
+_IDB, _OPB, _SPB, _EPB = 1, 2, 3, 6
+#Link layer types
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+_ETHERTYPE_IPV4 = 0x0800
+_ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+_IPPROTO_TCP = 6
+
+#Columns of preprocess_capture, as named by pyshark
+IP_FIELDS = ['src', 'dst', 'flags_df', 'flags_mf', 'hdr_len', 'len', 'ttl']
+TCP_FIELDS = ['srcport', 'dstport', 'flags_ack', 'flags_fin', 'flags_push',
+              'flags_reset', 'flags_syn', 'flags_urg', 'hdr_len', 'len']
+COLUMNS = ["ip_" + field for field in IP_FIELDS] + ["tcp_" + field for field in TCP_FIELDS]
+#Columns of the typed output
+TYPED_COLUMNS = ["timestamp"] + COLUMNS
+
+#Packet records found by scan_records (see iter_packet_records)
+RECORD_DTYPE = np.dtype([("timestamp", "f8"), ("linktype", "u2"), ("offset", "i8"),
+                         ("caplen", "i8"), ("record_offset", "i8")])
+#Decoded headers: capture time in seconds and one field per column (IPs as
+#integers, flags as 0/1)
+HEADER_DTYPE = np.dtype([
+    ("timestamp", "f8"), ("ip_src", "u4"), ("ip_dst", "u4"), ("ip_flags_df", "u1"), ("ip_flags_mf", "u1"),
+    ("ip_hdr_len", "u1"), ("ip_len", "u2"), ("ip_ttl", "u1"),
+    ("tcp_srcport", "u2"), ("tcp_dstport", "u2"), ("tcp_flags_ack", "u1"),
+    ("tcp_flags_fin", "u1"), ("tcp_flags_push", "u1"), ("tcp_flags_reset", "u1"),
+    ("tcp_flags_syn", "u1"), ("tcp_flags_urg", "u1"), ("tcp_hdr_len", "u1"),
+    ("tcp_len", "u2")])
+#Bit of each TCP flag in the flags byte
+_TCP_FLAG_BITS = {"tcp_flags_fin": 0, "tcp_flags_syn": 1, "tcp_flags_reset": 2,
+                  "tcp_flags_push": 3, "tcp_flags_ack": 4, "tcp_flags_urg": 5}
+
+@contextmanager
+def map_capture(path):
+    """Read-only memory map of a capture file (an empty bytes object for
+    empty files, which cannot be mapped)."""
+    with open(path, 'rb') as file_h:
+        try:
+            buf = mmap.mmap(file_h.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            yield b""
+            return
+        try:
+            yield buf
+        finally:
+            buf.close()
+
+def iter_packet_records(buf, start=0):
+    """Walks the packet records of a pcap or pcap-ng capture.
+
+    Args:
+        buf: Buffer with the whole capture (see map_capture).
+        start: Offset of the first record to read (0 reads the file header).
+            Must be the start of a record (or a pcap-ng section). The
+            pcap-ng blocks before it are only walked (type and length) to
+            decode their section headers and interface descriptions.
+
+    Yields:
+        Tuples (timestamp, linktype, offset, caplen, record_offset): capture
+        time in seconds, link layer type, offset and captured length of the
+        packet data, and offset of its record.
+
+    """
+    magic = bytes(buf[:4])
+    if magic in _PCAP_MAGIC:
+        return _iter_pcap(buf, start)
+    if magic == _PCAPNG_SHB:
+        return _iter_pcapng(buf, start)
+    if len(buf) == 0:
+        return iter(())
+    raise ValueError("Unknown capture file format (magic number %r)" % magic)
+
+def _iter_pcap(buf, start):
+    endian, resolution = _PCAP_MAGIC[bytes(buf[:4])]
+    linktype = struct.unpack_from(endian + "I", buf, 20)[0] & 0x0fffffff
+    record = struct.Struct(endian + "IIII")
+    pos = max(start, 24)
+    size = len(buf)
+    while pos + 16 <= size:
+        ts_sec, ts_frac, caplen, _ = record.unpack_from(buf, pos)
+        if pos + 16 + caplen > size:
+            #Truncated last record
+            break
+        yield (ts_sec + ts_frac * resolution, linktype, pos + 16, caplen, pos)
+        pos += 16 + caplen
+
+def _if_tsresol(buf, pos, end, endian):
+    """Timestamp resolution and offset from the options of an interface
+    description block."""
+    resolution, offset = 1e-6, 0
+    while pos + 4 <= end:
+        code, length = struct.unpack_from(endian + "HH", buf, pos)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            value = buf[pos + 4]
+            resolution = 2.0 ** -(value & 0x7f) if value & 0x80 else 10.0 ** -value
+        elif code == 14 and length >= 8:
+            offset = struct.unpack_from(endian + "q", buf, pos + 4)[0]
+        pos += 4 + (length + 3) // 4 * 4
+    return resolution, offset
+
+def _iter_pcapng(buf, start):
+    #Byte order and interfaces (linktype, resolution, offset) of the section
+    section = {"endian": "<", "interfaces": []}
+    if start > 0:
+        _skip_pcapng_blocks(buf, start, section)
+    return _iter_pcapng_blocks(buf, start, len(buf), section)
+
+def _skip_pcapng_blocks(buf, stop, section):
+    """Resuming: walks the blocks before stop reading only their type and
+    length. Only section header and interface description blocks are
+    decoded (into section)."""
+    header = struct.Struct(section["endian"] + "II")
+    pos = 0
+    stop = min(stop, len(buf))
+    while pos + 12 <= stop:
+        block_type, block_len = header.unpack_from(buf, pos)
+        #The section header type reads the same in both byte orders
+        if block_type == _SHB_TYPE or block_type == _IDB:
+            #Decoding just this block (it has no packets)
+            for _ in _iter_pcapng_blocks(buf, pos, pos + 12, section):
+                pass
+            header = struct.Struct(section["endian"] + "II")
+            block_len = header.unpack_from(buf, pos)[1]
+        if block_len < 12:
+            break
+        pos += block_len
+
+def _iter_pcapng_blocks(buf, pos, stop, section):
+    size = len(buf)
+    interfaces = section["interfaces"]
+    while pos + 12 <= min(stop, size):
+        block_type = bytes(buf[pos:pos + 4])
+        if block_type == _PCAPNG_SHB:
+            endian = _PCAPNG_BYTE_ORDER.get(bytes(buf[pos + 8:pos + 12]))
+            if endian is None:
+                raise ValueError("Invalid pcap-ng section header at %d" % pos)
+            section["endian"] = endian
+            #Interfaces are numbered per section
+            del interfaces[:]
+            block_len = struct.unpack_from(endian + "I", buf, pos + 4)[0]
+        else:
+            endian = section["endian"]
+            block_type, block_len = struct.unpack_from(endian + "II", buf, pos)
+        if block_len < 12 or pos + block_len > size:
+            break
+        end = pos + block_len - 4
+        if block_type == _IDB:
+            linktype = struct.unpack_from(endian + "H", buf, pos + 8)[0]
+            resolution, offset = _if_tsresol(buf, pos + 16, end, endian)
+            interfaces.append((linktype, resolution, offset))
+        elif block_type == _EPB or block_type == _OPB:
+            if block_type == _EPB:
+                if_id, ts_high, ts_low, caplen = struct.unpack_from(endian + "IIII",
+                                                                    buf, pos + 8)
+            else:
+                if_id, _, ts_high, ts_low, caplen = struct.unpack_from(endian + "HHIII",
+                                                                       buf, pos + 8)
+            linktype, resolution, offset = interfaces[if_id]
+            timestamp = ((ts_high << 32) | ts_low) * resolution + offset
+            yield (timestamp, linktype, pos + 28, min(caplen, end - pos - 28), pos)
+        elif block_type == _SPB and interfaces:
+            #No timestamp, always interface 0
+            wire_len = struct.unpack_from(endian + "I", buf, pos + 8)[0]
+            yield (float("nan"), interfaces[0][0], pos + 12,
+                   min(wire_len, end - pos - 12), pos)
+        pos += block_len
+
+def scan_records(buf, start=0):
+    """Array (RECORD_DTYPE) with the packet records of a capture (see
+    iter_packet_records)."""
+    return np.fromiter(iter_packet_records(buf, start), dtype=RECORD_DTYPE)
+
+def iter_record_chunks(buf, chunk_size=100000, chunk_seconds=None, start=0):
+    """Scans the packet records of a capture in chunks.
+
+    Args:
+        buf: Buffer with the whole capture (see map_capture).
+        chunk_size: Maximum number of records of a chunk (None for no
+            limit, if chunk_seconds is given).
+        chunk_seconds: If given, a chunk ends before the first record
+            captured chunk_seconds or more after its first record.
+        start: Offset of the first record (see iter_packet_records).
+
+    Yields:
+        Arrays (RECORD_DTYPE) of consecutive records.
+
+    """
+    if chunk_size is None and chunk_seconds is None:
+        raise ValueError("Either chunk_size or chunk_seconds is required")
+    if (chunk_size is not None and chunk_size < 1) or \
+            (chunk_seconds is not None and chunk_seconds <= 0):
+        raise ValueError("chunk_size and chunk_seconds must be positive")
+    records = iter_packet_records(buf, start)
+    block_size = chunk_size or 65536
+    pending = np.zeros(0, dtype=RECORD_DTYPE)
+    done = False
+    while not done:
+        block = np.fromiter(islice(records, block_size), dtype=RECORD_DTYPE)
+        done = len(block) < block_size
+        pending = np.concatenate([pending, block]) if len(pending) > 0 else block
+        while len(pending) > 0:
+            end = len(pending) if chunk_size is None else min(chunk_size, len(pending))
+            complete = done or end == chunk_size
+            if chunk_seconds is not None:
+                times = pending["timestamp"][:end]
+                late = np.flatnonzero(times >= times[0] + chunk_seconds)
+                if len(late) > 0:
+                    end, complete = late[0], True
+            if not complete:
+                #Reading more records
+                break
+            yield pending[:end]
+            pending = pending[end:]
+
+def _be16(data, pos):
+    """Big endian 16 bit values at positions pos of a uint8 array."""
+    return (data[pos].astype(np.uint16) << 8) | data[pos + 1]
+
+def _ipv4_offsets(data, records):
+    """Offset of the IPv4 header of each record, -1 if it does not carry
+    IPv4."""
+    offset = records["offset"]
+    end = offset + records["caplen"]
+    linktype = records["linktype"]
+    result = np.full(len(records), -1, dtype=np.int64)
+
+    #Ethernet, skipping VLAN tags
+    pos = offset + 12
+    sel = np.flatnonzero((linktype == LINKTYPE_ETHERNET) & (pos + 2 <= end))
+    ethertype = _be16(data, pos[sel])
+    while True:
+        vlan = np.isin(ethertype, _ETHERTYPE_VLAN) & (pos[sel] + 6 <= end[sel])
+        if not vlan.any():
+            break
+        pos[sel[vlan]] += 4
+        ethertype[vlan] = _be16(data, pos[sel[vlan]])
+    sel = sel[ethertype == _ETHERTYPE_IPV4]
+    result[sel] = pos[sel] + 2
+
+    #Linux cooked captures, protocol at 14 (v1) or 0 (v2)
+    for linktype_sll, proto_pos, length in ((LINKTYPE_LINUX_SLL, 14, 16),
+                                            (LINKTYPE_LINUX_SLL2, 0, 20)):
+        sel = np.flatnonzero((linktype == linktype_sll) & (offset + length <= end))
+        sel = sel[_be16(data, offset[sel] + proto_pos) == _ETHERTYPE_IPV4]
+        result[sel] = offset[sel] + length
+
+    #Loopback, address family in host (NULL) or network (LOOP) byte order
+    sel = np.flatnonzero(((linktype == LINKTYPE_NULL) | (linktype == LINKTYPE_LOOP)) &
+                         (offset + 4 <= end))
+    family = data[offset[sel][:, None] + np.arange(4)]
+    sel = sel[((family == [2, 0, 0, 0]) | (family == [0, 0, 0, 2])).all(axis=1)]
+    result[sel] = offset[sel] + 4
+
+    #Raw IP
+    sel = np.flatnonzero(((linktype == LINKTYPE_RAW) | (linktype == LINKTYPE_IPV4)) &
+                         (offset < end))
+    result[sel] = offset[sel]
+    return result
+
+def decode_tcp_headers(buf, records):
+    """Decodes the IPv4 and TCP headers of the packets of a capture.
+
+    Only packets with the first fragment of a TCP segment over IPv4, whose
+    headers were captured, are kept.
+
+    Args:
+        buf: Buffer with the capture (see map_capture).
+        records: Array of packet records (see scan_records).
+
+    Returns:
+        Tuple (headers, kept): array with HEADER_DTYPE and the positions in
+        records of its packets.
+
+    """
+    data = np.frombuffer(buf, dtype=np.uint8) if len(buf) > 0 else np.zeros(0, np.uint8)
+    end = records["offset"] + records["caplen"]
+    ip = _ipv4_offsets(data, records)
+    kept = np.flatnonzero((ip >= 0) & (ip + 20 <= end))
+    ip = ip[kept]
+    #Fixed part of the IPv4 header
+    ip_hdr = data[ip[:, None] + np.arange(20)]
+    ip_hdr_len = (ip_hdr[:, 0] & 0x0f).astype(np.uint16) * 4
+    frag = (ip_hdr[:, 6].astype(np.uint16) << 8) | ip_hdr[:, 7]
+    tcp = ip + ip_hdr_len
+    sel = np.flatnonzero((ip_hdr[:, 0] >> 4 == 4) & (ip_hdr[:, 9] == _IPPROTO_TCP) &
+                         (frag & 0x1fff == 0) & (tcp + 20 <= end[kept]))
+    kept, ip_hdr, ip_hdr_len, tcp = kept[sel], ip_hdr[sel], ip_hdr_len[sel], tcp[sel]
+    #Fixed part of the TCP header
+    tcp_hdr = data[tcp[:, None] + np.arange(20)]
+
+    headers = np.empty(len(kept), dtype=HEADER_DTYPE)
+    headers["timestamp"] = records["timestamp"][kept]
+    ip_words = ip_hdr[:, 12:20].astype(np.uint32)
+    headers["ip_src"] = ((ip_words[:, 0] << 24) | (ip_words[:, 1] << 16) |
+                         (ip_words[:, 2] << 8) | ip_words[:, 3])
+    headers["ip_dst"] = ((ip_words[:, 4] << 24) | (ip_words[:, 5] << 16) |
+                         (ip_words[:, 6] << 8) | ip_words[:, 7])
+    headers["ip_flags_df"] = (ip_hdr[:, 6] >> 6) & 1
+    headers["ip_flags_mf"] = (ip_hdr[:, 6] >> 5) & 1
+    headers["ip_hdr_len"] = ip_hdr_len
+    ip_len = (ip_hdr[:, 2].astype(np.int32) << 8) | ip_hdr[:, 3]
+    headers["ip_len"] = ip_len
+    headers["ip_ttl"] = ip_hdr[:, 8]
+    headers["tcp_srcport"] = (tcp_hdr[:, 0].astype(np.uint16) << 8) | tcp_hdr[:, 1]
+    headers["tcp_dstport"] = (tcp_hdr[:, 2].astype(np.uint16) << 8) | tcp_hdr[:, 3]
+    for field, bit in _TCP_FLAG_BITS.items():
+        headers[field] = (tcp_hdr[:, 13] >> bit) & 1
+    tcp_hdr_len = (tcp_hdr[:, 12] >> 4).astype(np.int32) * 4
+    headers["tcp_hdr_len"] = tcp_hdr_len
+    headers["tcp_len"] = np.maximum(ip_len - ip_hdr_len - tcp_hdr_len, 0)
+    return headers, kept
+
+def headers_frame(headers, index=None):
+    """DataFrame whose columns are views of the fields of a structured
+    array (no data is copied)."""
+    return pd.DataFrame({name: headers[name] for name in headers.dtype.names},
+                        index=index, copy=False)
+
+def ipv4_to_uint32(values):
+    """Integers (uint32 array) of dotted IPv4 addresses, leading zeros
+    allowed as in the DARPA list files."""
+    values = pd.Series(values, dtype=str)
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.uint32)
+    octets = values.str.split(".", expand=True, n=3)
+    if octets.shape[1] != 4 or octets.isna().any(axis=None):
+        raise ValueError("Invalid IPv4 addresses")
+    octets = octets.astype(np.uint32).to_numpy()
+    return (octets[:, 0] << 24) | (octets[:, 1] << 16) | (octets[:, 2] << 8) | octets[:, 3]
+
+def uint32_to_ipv4(values):
+    """Dotted IPv4 addresses (strings) of an array of integers."""
+    values = np.asarray(values, dtype=np.uint32)
+    octets = [pd.Series((values >> shift) & 0xff).astype(str) for shift in (24, 16, 8, 0)]
+    return (octets[0] + "." + octets[1] + "." + octets[2] + "." + octets[3]).to_numpy()
@@ -0,0 +1,191 @@
+"""
+Tests for the native capture reader.
+"""
+import socket
+import struct
+import numpy as np
+import pytest
+import pandas as pd
+from ..classes import preprocess_capture, iter_capture
+from ..reader import COLUMNS, map_capture, scan_records, decode_tcp_headers
+from ..reader import headers_frame, ipv4_to_uint32, uint32_to_ipv4
+from ..reader import HEADER_DTYPE, TYPED_COLUMNS
+
+def _ipv4_packet(src, dst, proto, payload, ttl=64, flags=0x4000):
+    header = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(payload), 1, flags, ttl,
+                         proto, 0, socket.inet_aton(src), socket.inet_aton(dst))
+    return header + payload
+
+def _tcp_frame(src, dst, sport, dport, flags, payload=b"", ttl=64, vlan=False,
+               ip_flags=0x4000):
+    """Ethernet frame with an IPv4 TCP segment (20 bytes of options if the
+    segment carries a payload, to test header lengths)."""
+    options = b"\x01" * 20 if payload else b""
+    tcp = struct.pack("!HHIIBBHHH", sport, dport, 1, 0, (5 + len(options) // 4) << 4,
+                      flags, 8192, 0, 0) + options + payload
+    ip = _ipv4_packet(src, dst, 6, tcp, ttl, ip_flags)
+    ethernet = b"\x00\x11\x22\x33\x44\x55" * 2
+    if vlan:
+        ethernet += b"\x81\x00\x00\x07"
+    return ethernet + b"\x08\x00" + ip
+
+def _frames():
+    """Frames of a capture with their expected rows (None if skipped)."""
+    return [
+        (_tcp_frame("192.168.1.30", "10.0.0.1", 1754, 80, 0x02), {
+            "ip_src": "192.168.1.30", "ip_dst": "10.0.0.1", "ip_flags_df": "1",
+            "ip_flags_mf": "0", "ip_hdr_len": "20", "ip_len": "40", "ip_ttl": "64",
+            "tcp_srcport": "1754", "tcp_dstport": "80", "tcp_flags_ack": "0",
+            "tcp_flags_fin": "0", "tcp_flags_push": "0", "tcp_flags_reset": "0",
+            "tcp_flags_syn": "1", "tcp_flags_urg": "0", "tcp_hdr_len": "20",
+            "tcp_len": "0"}),
+        (_tcp_frame("10.0.0.1", "192.168.1.30", 80, 1754, 0x39, b"x" * 100, ttl=128,
+                    vlan=True, ip_flags=0), {
+            "ip_src": "10.0.0.1", "ip_dst": "192.168.1.30", "ip_flags_df": "0",
+            "ip_flags_mf": "0", "ip_hdr_len": "20", "ip_len": "160", "ip_ttl": "128",
+            "tcp_srcport": "80", "tcp_dstport": "1754", "tcp_flags_ack": "1",
+            "tcp_flags_fin": "1", "tcp_flags_push": "1", "tcp_flags_reset": "0",
+            "tcp_flags_syn": "0", "tcp_flags_urg": "1", "tcp_hdr_len": "40",
+            "tcp_len": "100"}),
+        #UDP, ARP and a TCP fragment other than the first one are skipped
+        (b"\x00" * 12 + b"\x08\x00" + _ipv4_packet("1.2.3.4", "5.6.7.8", 17, b"\x00" * 8),
+         None),
+        (b"\x00" * 12 + b"\x08\x06" + b"\x00" * 28, None),
+        (_tcp_frame("1.2.3.4", "5.6.7.8", 1, 2, 0x10, ip_flags=0x0004), None),
+        (_tcp_frame("172.16.0.1", "172.16.0.2", 23, 40000, 0x14, ttl=1,
+                    ip_flags=0x2000), {
+            "ip_src": "172.16.0.1", "ip_dst": "172.16.0.2", "ip_flags_df": "0",
+            "ip_flags_mf": "1", "ip_hdr_len": "20", "ip_len": "40", "ip_ttl": "1",
+            "tcp_srcport": "23", "tcp_dstport": "40000", "tcp_flags_ack": "1",
+            "tcp_flags_fin": "0", "tcp_flags_push": "0", "tcp_flags_reset": "1",
+            "tcp_flags_syn": "0", "tcp_flags_urg": "0", "tcp_hdr_len": "20",
+            "tcp_len": "0"}),
+    ]
+
+def write_pcap(path, frames, times, endian="<", nsec=False, linktype=1):
+    """Writes a classic pcap file (with Ethernet frames by default)."""
+    magic = 0xa1b23c4d if nsec else 0xa1b2c3d4
+    with open(path, 'wb') as file_h:
+        file_h.write(struct.pack(endian + "IHHiIII", magic, 2, 4, 0, 0, 65535, linktype))
+        for frame, time in zip(frames, times):
+            sec = int(time)
+            frac = int(round((time - sec) * (1e9 if nsec else 1e6)))
+            file_h.write(struct.pack(endian + "IIII", sec, frac, len(frame), len(frame)))
+            file_h.write(frame)
+
+def _pad(data):
+    return data + b"\x00" * (-len(data) % 4)
+
+def _block(block_type, body):
+    body = _pad(body)
+    return struct.pack("<II", block_type, len(body) + 12) + body + \
+        struct.pack("<I", len(body) + 12)
+
+def write_pcapng(path, frames, times, tsresol=6):
+    """Writes a pcap-ng file with Ethernet frames in enhanced packet blocks."""
+    with open(path, 'wb') as file_h:
+        file_h.write(_block(0x0A0D0D0A, struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1)))
+        options = struct.pack("<HHB", 9, 1, tsresol) + b"\x00" * 3 + struct.pack("<HH", 0, 0)
+        file_h.write(_block(1, struct.pack("<HHI", 1, 0, 65535) + options))
+        for frame, time in zip(frames, times):
+            stamp = int(round(time * 10 ** tsresol))
+            file_h.write(_block(6, struct.pack("<IIIII", 0, stamp >> 32, stamp & 0xffffffff,
+                                               len(frame), len(frame)) + frame))
+
+def test_native_reader(tmp_path):
+    """pcap and pcap-ng files give the columns and values of pyshark
+    """
+    frames = [frame for frame, _ in _frames()]
+    times = [1000000000.25 + i for i in range(len(frames))]
+    expected = pd.DataFrame([row for _, row in _frames() if row is not None],
+                            columns=COLUMNS)
+    files = []
+    for i, (endian, nsec) in enumerate([("<", False), (">", False), ("<", True)]):
+        files.append(str(tmp_path / ("capture%d.pcap" % i)))
+        write_pcap(files[-1], frames, times, endian, nsec)
+    files.append(str(tmp_path / "capture.pcapng"))
+    write_pcapng(files[-1], frames, times)
+    for path in files:
+        X = preprocess_capture(path, typed=False)
+        assert X.equals(expected)
+    #Truncated last record and empty file
+    with open(files[0], 'rb') as file_h:
+        data = file_h.read()
+    (tmp_path / "truncated.pcap").write_bytes(data[:-10])
+    assert preprocess_capture(str(tmp_path / "truncated.pcap"),
+                              typed=False).equals(expected.iloc[:2])
+    (tmp_path / "empty.pcap").write_bytes(b"")
+    assert list(preprocess_capture(str(tmp_path / "empty.pcap"),
+                                   typed=False).columns) == COLUMNS
+    X = preprocess_capture(str(tmp_path / "empty.pcap"))
+    assert list(X.columns) == TYPED_COLUMNS and len(X) == 0
+
+def test_typed_headers(tmp_path):
+    """Typed output is a view of the decoded headers, for every link layer
+    """
+    frames = [frame for frame, _ in _frames()]
+    expected = pd.DataFrame([row for _, row in _frames() if row is not None],
+                            columns=COLUMNS)
+    #Same IP packets over raw IP, Linux cooked and loopback link layers
+    link_layers = {1: None, 101: b"", 113: b"\x00" * 14 + b"\x08\x00",
+                   0: b"\x02\x00\x00\x00", 108: b"\x00\x00\x00\x02"}
+    for linktype, header in link_layers.items():
+        path = str(tmp_path / ("capture%d.pcap" % linktype))
+        packets = frames
+        if header is not None:
+            packets = [header + frame[18 if frame[12:14] == b"\x81\x00" else 14:]
+                       for frame in frames]
+        write_pcap(path, packets, range(len(frames)), linktype=linktype)
+        X = preprocess_capture(path)
+        assert list(X.columns) == TYPED_COLUMNS
+        assert (X.dtypes == [HEADER_DTYPE[col] for col in TYPED_COLUMNS]).all()
+        assert list(X.timestamp) == [0.0, 1.0, 5.0]
+        assert list(uint32_to_ipv4(X.ip_src)) == list(expected.ip_src)
+        assert (X[COLUMNS[2:]].astype(str) == expected[COLUMNS[2:]]).all().all()
+    with map_capture(path) as buf:
+        records = scan_records(buf)
+        headers, kept = decode_tcp_headers(buf, records)
+    assert list(kept) == [0, 1, 5]
+    assert list(records["record_offset"][1:]) == list(
+        records["offset"][:-1] + records["caplen"][:-1])
+    X = headers_frame(headers)
+    assert all(np.shares_memory(X[col].to_numpy(), headers) for col in TYPED_COLUMNS)
+    assert list(ipv4_to_uint32(expected.ip_dst)) == list(X.ip_dst)
+
+def test_iter_capture(tmp_path):
+    """Chunks by packets or time cover the capture and can be resumed
+    """
+    frames = [frame for frame, _ in _frames()] * 3
+    times = [0, 0.5, 1, 4, 4.5, 9, 9.2, 9.4, 9.6, 9.8, 20, 21, 22, 40, 41, 42, 43, 44]
+    pcap, pcapng = str(tmp_path / "capture.pcap"), str(tmp_path / "capture.pcapng")
+    write_pcap(pcap, frames, times)
+    write_pcapng(pcapng, frames, times)
+    for path in [pcap, pcapng]:
+        X = preprocess_capture(path)
+        chunks = list(iter_capture(path, chunk_size=4))
+        assert [len(chunk) for _, chunk in chunks] == [2, 3, 1, 2, 1]
+        assert pd.concat([chunk for _, chunk in chunks], ignore_index=True).equals(X)
+        #Resuming from the offset of a chunk
+        offset = chunks[2][0]
+        resumed = list(iter_capture(path, chunk_size=4, start=offset))
+        assert [off for off, _ in resumed] == [off for off, _ in chunks[2:]]
+        assert all(chunk.equals(old) for (_, chunk), (_, old) in zip(resumed, chunks[2:]))
+        #Time windows of 5 seconds from the first packet of each chunk
+        chunks = list(iter_capture(path, chunk_size=None, chunk_seconds=5, as_frame=False))
+        assert [list(chunk["timestamp"]) for _, chunk in chunks] == [
+            [0, 0.5], [9, 9.2, 9.4], [21, 22], [40, 44]]
+        assert chunks[0][1].dtype == HEADER_DTYPE
+        #Both limits (records at 4 and 4.5 carry no TCP packets)
+        chunks = list(iter_capture(path, chunk_size=3, chunk_seconds=5))
+        assert [list(chunk.timestamp) for _, chunk in chunks][:3] == [[0, 0.5], [], [9, 9.2, 9.4]]
+    #Resuming does not decode the packet blocks before start (the first
+    #one is made invalid)
+    offsets = [off for off, _ in iter_capture(pcapng, chunk_size=4)]
+    data = bytearray(open(pcapng, 'rb').read())
+    data[offsets[0] + 8:offsets[0] + 12] = struct.pack("<I", 7)
+    (tmp_path / "invalid.pcapng").write_bytes(bytes(data))
+    resumed = list(iter_capture(str(tmp_path / "invalid.pcapng"), chunk_size=4,
+                                start=offsets[2]))
+    assert [off for off, _ in resumed] == offsets[2:]
+    with pytest.raises(ValueError):
+        next(iter_capture(pcap, chunk_size=None))
@@ -0,0 +1,76 @@
+"""
+Tests for the flow assembly.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from ..flows import FlowTable, FLOW_COLUMNS, preprocess_flows
+from ..reader import ipv4_to_uint32
+from .test_capture_reader import _tcp_frame, write_pcap
+
+def _packets(rows):
+    """Typed packets from (time, src, sport, dst, dport, flags, ip_len)."""
+    X = pd.DataFrame(rows, columns=["timestamp", "ip_src", "tcp_srcport", "ip_dst",
+                                    "tcp_dstport", "flags", "ip_len"])
+    X["ip_src"] = ipv4_to_uint32(X.ip_src)
+    X["ip_dst"] = ipv4_to_uint32(X.ip_dst)
+    for flag, bit in [("fin", 0), ("syn", 1), ("reset", 2), ("push", 3), ("ack", 4),
+                      ("urg", 5)]:
+        X["tcp_flags_" + flag] = (X["flags"].to_numpy() >> bit) & 1
+    return X
+
+def test_flow_table():
+    """Both directions update one flow, which ends on timeouts
+    """
+    table = FlowTable(idle_timeout=10, active_timeout=20)
+    flows = table.update(_packets([
+        (0.0, "10.0.0.2", 1025, "10.0.0.1", 80, 0x02, 60),
+        (0.5, "10.0.0.1", 80, "10.0.0.2", 1025, 0x12, 60),
+        (1.5, "10.0.0.2", 1025, "10.0.0.1", 80, 0x18, 140),
+        (2.0, "10.0.0.3", 2000, "10.0.0.1", 22, 0x02, 40)]))
+    assert len(flows) == 0 and len(table) == 2
+    #10.0.0.2 flow is idle, the ssh flow exceeds the active timeout
+    flows = pd.concat([table.update(_packets([
+        (11.0, "10.0.0.3", 2000, "10.0.0.1", 22, 0x10, 40),
+        (20.0, "10.0.0.3", 2000, "10.0.0.1", 22, 0x18, 40),
+        (23.0, "10.0.0.1", 22, "10.0.0.3", 2000, 0x11, 40)])),
+                       table.flush()], ignore_index=True)
+    assert list(flows.columns) == FLOW_COLUMNS
+    assert list(flows.end_reason) == ["idle", "active", "flush"]
+    first = flows.iloc[0]
+    assert first.ip_src == ipv4_to_uint32(["10.0.0.2"])[0] and first.tcp_dstport == 80
+    assert (first.packets, first.bytes, first.fwd_packets, first.bwd_packets,
+            first.fwd_bytes, first.bwd_bytes) == (3, 260, 2, 1, 200, 60)
+    assert (first.syn_count, first.ack_count, first.push_count) == (2, 2, 1)
+    assert first.duration == 1.5 and first.iat_min == 0.5 and first.iat_max == 1.0
+    assert first.iat_mean == 0.75 and first.iat_std == pytest.approx(0.25)
+    assert list(flows.packets) == [3, 3, 1]
+    assert flows.iloc[2].ip_src == ipv4_to_uint32(["10.0.0.1"])[0]
+    assert flows.iloc[2].iat_std == 0 and flows.iloc[2].iat_min == 0
+    assert len(table) == 0
+
+def test_flow_table_capacity():
+    """Active flows are bounded by max_flows
+    """
+    table = FlowTable(max_flows=2)
+    flows = table.update(_packets([(i, "10.0.0.1", 1000 + i, "10.0.0.2", 80, 0x02, 40)
+                                   for i in range(5)]))
+    assert len(table) == 2
+    assert list(flows.tcp_srcport) == [1000, 1001, 1002]
+    assert (flows.end_reason == "capacity").all()
+    with pytest.raises(ValueError):
+        FlowTable(idle_timeout=0)
+
+def test_preprocess_flows(tmp_path):
+    """Flows of a capture file
+    """
+    frames = [_tcp_frame("192.168.1.30", "10.0.0.1", 1754, 80, 0x02),
+              _tcp_frame("10.0.0.1", "192.168.1.30", 80, 1754, 0x12),
+              _tcp_frame("172.16.0.1", "172.16.0.2", 23, 40000, 0x14),
+              _tcp_frame("192.168.1.30", "10.0.0.1", 1754, 80, 0x10, b"x" * 10)]
+    path = str(tmp_path / "capture.pcap")
+    write_pcap(path, frames, [0, 1, 200, 201])
+    flows = preprocess_flows(path)
+    assert list(flows.end_reason) == ["idle", "flush", "flush"]
+    assert list(flows.packets) == [2, 1, 1]
+    assert flows.dtypes["packets"] == np.uint64
@@ -3,3 +3,4 @@ Web package
 '''
 
 import skinfosec.models.anomaly.web.classes
+import skinfosec.models.anomaly.web.follow
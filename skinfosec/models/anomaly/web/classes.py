@@ -2,60 +2,926 @@
 Classes and functions for anomaly detection over webserver log files.
 """
 
+import bz2
+import fnmatch
+import functools
+import glob
+import gzip
+import io
+import itertools
 import logging
+import lzma
+import os
+import re
+import tarfile
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 #import string
+from collections import Counter
 import urllib.parse as urlparse
-from scipy.stats import chisquare
-from sklearn.base import BaseEstimator, ClusterMixin
-from sklearn.cluster import KMeans
+import numpy as np
+import scipy.sparse as sp
+from scipy.special import chdtrc
+from sklearn.base import BaseEstimator, ClusterMixin, TransformerMixin
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.feature_extraction import FeatureHasher
 import pandas as pd
-from apache_log_parser import make_parser
-from ..base import BaseAnomalyDetector
+from apache_log_parser import make_parser, LineDoesntMatchException
+from ..base import BaseAnomalyDetector, NULL_PROFILER
 
-def preprocess_requests(data, log_format):
+#Columns kept for each of the supported log formats
+_LOG_COLUMNS = {
+    "CLF": ["remote_host", "remote_logname", "remote_user",
+            "time_received_tz_datetimeobj", "request_http_ver", "request_method",
+            "request_url", "status", "response_bytes_clf"],
+    "Combined": ["remote_host", "remote_logname", "remote_user",
+                 "time_received_tz_datetimeobj", "request_http_ver", "request_method",
+                 "request_url", "status", "response_bytes_clf", "request_header_referer",
+                 "request_header_user_agent"]}
+
+#apache_log_parser format strings for each of the supported log formats
+_LOG_FORMAT_STRINGS = {
+    "CLF": '%h %l %u %t \"%r\" %>s %b',
+    "Combined": '%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\"'}
+
+#Compiled regular expressions equivalent to the apache_log_parser ones, used by
+#the "regex" engine
+_CLF_PATTERN = (r'^(?P<remote_host>.*?) (?P<remote_logname>.*?) (?P<remote_user>.*?) '
+                r'\[(?P<time_received>.*?)\] "(?P<request_first_line>.*?)" '
+                r'(?P<status>[0-9]+?|-) (?P<response_bytes_clf>\d+|-)')
+_LOG_REGEXES = {
+    "CLF": re.compile(_CLF_PATTERN),
+    "Combined": re.compile(_CLF_PATTERN + r' "(?P<request_header_referer>.*?)" '
+                           r'"(?P<request_header_user_agent>.*?)"')}
+_REQUEST_LINE_REGEX = re.compile(
+    r'^(?P<request_method>GET|HEAD|POST|OPTIONS|PUT|CONNECT|PATCH|PROPFIND|DELETE)'
+    r'\s?(?P<request_url>.{,10000}?)(?:\s+HTTP/(?P<request_http_ver>1.[01]))?$')
+
+#Low cardinality columns stored as category by the typed output
+_CATEGORY_COLUMNS = ["remote_host", "remote_logname", "remote_user", "request_http_ver",
+                     "request_method", "request_header_referer",
+                     "request_header_user_agent"]
+
+def _to_typed(X):
+    """Converts parsed log columns to compact dtypes (in place).
+
+    Repeated strings become category, status Int16, response_bytes_clf
+    Int64 ("-" becomes NA) and the timestamps UTC datetime64.
+    """
+    for col in _CATEGORY_COLUMNS:
+        if col in X:
+            X[col] = X[col].astype("category")
+    for col, dtype in (("status", "Int16"), ("response_bytes_clf", "Int64")):
+        if col in X:
+            X[col] = pd.to_numeric(X[col].where(X[col] != "-")).astype(dtype)
+    col = "time_received_tz_datetimeobj"
+    if col in X and not isinstance(X[col].dtype, pd.DatetimeTZDtype):
+        X[col] = pd.to_datetime(X[col], utc=True)
+    return X
+
+def _parse_lines_regex(lines, log_format):
+    """Parses a chunk of log lines with the "regex" engine.
+
+    Args:
+        lines: List of log lines.
+        log_format: Either "CLF" or "Combined".
+
+    Returns:
+        pandas.DataFrame with the parsed data.
+
+    """
+    regex = _LOG_REGEXES[log_format]
+    lines = pd.Series(lines, dtype=object)
+    parsed = lines.str.extract(regex)
+    unmatched = parsed["remote_host"].isna()
+    if unmatched.any():
+        raise LineDoesntMatchException(log_line=lines[unmatched.idxmax()],
+                                       regex=regex.pattern)
+    request = parsed["request_first_line"].str.extract(_REQUEST_LINE_REGEX)
+    #Possibly garbage, ignore it (as apache_log_parser does)
+    garbage = request["request_method"].isna()
+    request.loc[garbage, ["request_method", "request_url", "request_http_ver"]] = ""
+    parsed["time_received_tz_datetimeobj"] = pd.to_datetime(
+        parsed["time_received"], format="%d/%b/%Y:%H:%M:%S %z", utc=True)
+    parsed = pd.concat([parsed, request], axis=1)
+    return parsed[_LOG_COLUMNS[log_format]]
+
+def preprocess_requests(data, log_format, engine="regex", typed=False):
     """Gets logs in NCSA Common Log Format (CLF) or NCSA Combined.
 
     Args:
         data: File handle for log file.
-        log_format: Either "CLF" or "Combined".
+        log_format: Either "CLF", "Combined" or an Apache LogFormat string
+            (e.g. '%h %l %u %t \"%r\" %>s %b %D').
+        engine: Either "regex" (default), which parses all the lines with
+            one compiled regular expression and converts the timestamps to
+            UTC in a single call, or "apache_log_parser". Apache LogFormat
+            strings are always parsed with apache_log_parser and keep all the
+            fields it returns.
+        typed: If True, columns get compact dtypes instead of strings:
+            category for repeated strings (hosts, users, method, HTTP
+            version, referer and user agent), Int16 status, Int64
+            response_bytes_clf ("-" becomes NA) and UTC datetime64
+            timestamps.
 
     Returns:
         pandas.DataFrame with the parsed data.
 
     """
     #SEE: https://www.w3.org/Daemon/User/Config/Logging.html#common-logfile-format
-    if log_format == "CLF":
-        cols = ["remote_host", "remote_logname", "remote_user",
-                "time_received_tz_datetimeobj", "request_http_ver", "request_method",
-                "request_url", "status", "response_bytes_clf"]
-        parser = make_parser('%h %l %u %t \"%r\" %>s %b')
-    elif log_format == "Combined":
-        cols = ["remote_host", "remote_logname", "remote_user",
-                "time_received_tz_datetimeobj", "request_http_ver", "request_method",
-                "request_url", "status", "response_bytes_clf", "request_header_referer",
-                "request_header_user_agent"]
-        parser = make_parser('%h %l %u %t \"%r\" %>s %b \"%{Referer}i\" \"%{User-Agent}i\"')
+    if log_format in _LOG_COLUMNS:
+        cols = _LOG_COLUMNS[log_format]
+        format_string = _LOG_FORMAT_STRINGS[log_format]
+    elif "%" in log_format:
+        cols = None
+        format_string = log_format
+        engine = "apache_log_parser"
     else:
-        raise ValueError("format must be CLF or Combined")
+        raise ValueError("format must be CLF, Combined or an Apache LogFormat string")
 
+    if engine == "regex":
+        X = _parse_lines_regex(list(data), log_format)
+        return _to_typed(X) if typed else X
+    elif engine != "apache_log_parser":
+        raise ValueError("engine must be regex or apache_log_parser")
+
+    parser = make_parser(format_string)
     #Temporary list to feed the final DataFrame (for better performance)
     log_lst = []
     for line in data:
         parsed = parser(line)
-        filtered = {k: v for k, v in parsed.items() if k in cols}
-        log_lst.append(filtered)
+        if cols is not None:
+            parsed = {k: v for k, v in parsed.items() if k in cols}
+        log_lst.append(parsed)
     X = pd.DataFrame(log_lst, columns=cols)
-    return X
+    return _to_typed(X) if typed else X
+
+def preprocess_requests_chunks(data, log_format, chunksize=100000, engine="regex",
+                               typed=False):
+    """Generator version of preprocess_requests.
+
+    Lines are read from data and parsed chunksize at a time, so memory is
+    bounded by the size of a chunk instead of the size of the log.
+
+    Args:
+        data: File handle for log file.
+        log_format: See preprocess_requests.
+        chunksize: Maximum number of lines per chunk.
+        engine, typed: See preprocess_requests.
+
+    Yields:
+        pandas.DataFrame with the parsed data of each chunk. The index keeps
+        counting across chunks (i.e. it is the line number in data).
+
+    """
+    if chunksize < 1:
+        raise ValueError("chunksize must be positive")
+    data = iter(data)
+    offset = 0
+    while True:
+        lines = list(itertools.islice(data, chunksize))
+        if len(lines) == 0:
+            return
+        X = preprocess_requests(lines, log_format, engine=engine, typed=typed)
+        X.index = pd.RangeIndex(offset, offset + len(X))
+        offset += len(X)
+        yield X
+
+def _effective_n_jobs(n_jobs):
+    """Number of processes for n_jobs: None means 1, negative values count
+    from the number of CPUs (-1 is all of them)."""
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max((os.cpu_count() or 1) + 1 + n_jobs, 1)
+    return max(n_jobs, 1)
+
+def _imap_bounded(executor, func, iterable, max_pending):
+    """Ordered executor.map which keeps at most max_pending tasks submitted,
+    so that iterable is not consumed ahead of the results."""
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def _line_aligned_ranges(path, n_ranges):
+    """Splits a file in up to n_ranges byte ranges starting at line starts.
+
+    Returns:
+        List of (start, stop) byte offsets.
+
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as file_h:
+        for i in range(1, n_ranges):
+            pos = size * i // n_ranges
+            if pos <= bounds[-1]:
+                continue
+            #Moving to the start of the line after the one holding pos-1
+            file_h.seek(pos - 1)
+            file_h.readline()
+            bounds.append(min(file_h.tell(), size))
+    bounds.append(size)
+    return [(start, stop) for start, stop in zip(bounds, bounds[1:]) if stop > start]
+
+def _parse_byte_range(path, start, stop, log_format, engine, encoding):
+    """Parses the lines in bytes [start, stop) of a log file."""
+    with open(path, 'rb') as file_h:
+        file_h.seek(start)
+        data = file_h.read(stop - start)
+    lines = io.TextIOWrapper(io.BytesIO(data), encoding=encoding)
+    return preprocess_requests(lines, log_format, engine=engine)
+
+#Streaming decompressors by file suffix
+_COMPRESSED_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+_TAR_SUFFIXES = (".tar", ".tgz", ".tar.gz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+#Rotated logs: access_log.3 (3 is older than 2) or access_log-20060228 (dates)
+_ROTATION_REGEX = re.compile(r"^(.*?)[.-](\d+)$")
+
+def _open_log(source, name, encoding=None):
+    """Text handle over a log file (path or binary file object) which is
+    decompressed on the fly when name ends in .gz, .bz2 or .xz."""
+    opener = _COMPRESSED_OPENERS.get(os.path.splitext(name)[1])
+    if opener is not None:
+        return opener(source, 'rt', encoding=encoding)
+    if isinstance(source, str):
+        return open(source, encoding=encoding)
+    return io.TextIOWrapper(source, encoding=encoding)
+
+def _is_tar(path):
+    return path.endswith(_TAR_SUFFIXES)
+
+def _rotation_key(name):
+    """Sort key putting rotated files of a log from oldest to newest and
+    the live file (no rotation suffix) last."""
+    stem, ext = os.path.splitext(name)
+    if ext not in _COMPRESSED_OPENERS:
+        stem = name
+    match = _ROTATION_REGEX.match(stem)
+    if match is None:
+        return (stem, 1, 0)
+    number = int(match.group(2))
+    #Dates grow with time, rotation indexes grow with age
+    return (match.group(1), 0, number if len(match.group(2)) >= 8 else -number)
+
+def _expand_log_sources(sources):
+    """Paths of the log files (or tar archives) in sources, a path, a glob
+    or a list of them. Each glob is sorted with _rotation_key."""
+    if isinstance(sources, str):
+        sources = [sources]
+    paths = []
+    for source in sources:
+        if any(char in source for char in "*?["):
+            matches = sorted(glob.glob(source), key=_rotation_key)
+            if len(matches) == 0:
+                raise IOError("No files match %s" % source)
+            paths.extend(matches)
+        else:
+            paths.append(source)
+    return paths
+
+def _tar_members(tar, members):
+    """Regular files of an open tar archive matching the members pattern."""
+    for member in tar:
+        if member.isfile() and fnmatch.fnmatch(member.name, members):
+            yield member
+
+def open_request_logs(sources, members="*", encoding=None):
+    """Lines of a set of (possibly compressed or archived) log files.
+
+    Files are read in place: .gz, .bz2 and .xz files are decompressed while
+    being read and tar archives are not extracted. Rotated files are read
+    from oldest to newest (access_log.2, access_log.1, access_log).
+
+    Args:
+        sources: Path, glob or list of paths/globs. Files are read in the
+            given order, the files matched by a glob or stored in a tar
+            archive in rotation order.
+        members: fnmatch pattern selecting the members of tar archives
+            (e.g. "var/log/httpd/access_log*").
+        encoding: Text encoding of the logs (default: same as open()).
+
+    Yields:
+        The lines of the logs, to be used with preprocess_requests or
+        preprocess_requests_chunks.
+
+    """
+    for path in _expand_log_sources(sources):
+        if not _is_tar(path):
+            with _open_log(path, path, encoding) as lines:
+                yield from lines
+            continue
+        with tarfile.open(path, "r:*") as tar:
+            names = sorted(_tar_members(tar, members),
+                           key=lambda member: _rotation_key(member.name))
+            for member in names:
+                with _open_log(tar.extractfile(member), member.name, encoding) as lines:
+                    yield from lines
+
+def _parse_file(path, log_format, engine, encoding):
+    """Parses a whole (possibly compressed) log file."""
+    with _open_log(path, path, encoding) as lines:
+        return preprocess_requests(lines, log_format, engine=engine)
+
+def _parse_bytes(data, name, log_format, engine, encoding):
+    """Parses the content of a (possibly compressed) log file."""
+    with _open_log(io.BytesIO(data), name, encoding) as lines:
+        return preprocess_requests(lines, log_format, engine=engine)
+
+def _log_tasks(paths, members, n_ranges, log_format, engine, encoding):
+    """Parsing tasks (sort key, function, arguments) for the log files.
+
+    Plain files are split in n_ranges byte ranges, compressed files are
+    decompressed by the task and tar archives are streamed here, once, so
+    that the members are decompressed while the previous ones are parsed.
+    """
+    for i, path in enumerate(paths):
+        if _is_tar(path):
+            #Streaming mode: members are read in archive order
+            with tarfile.open(path, "r|*") as tar:
+                for member in _tar_members(tar, members):
+                    data = tar.extractfile(member).read()
+                    yield ((i, _rotation_key(member.name)), _parse_bytes,
+                           (data, member.name, log_format, engine, encoding))
+        elif os.path.splitext(path)[1] in _COMPRESSED_OPENERS or n_ranges == 1:
+            yield ((i, None), _parse_file, (path, log_format, engine, encoding))
+        else:
+            for j, (start, stop) in enumerate(_line_aligned_ranges(path, n_ranges)):
+                yield ((i, j), _parse_byte_range,
+                       (path, start, stop, log_format, engine, encoding))
+
+def _run_task(task):
+    func, args = task
+    return func(*args)
+
+def preprocess_requests_parallel(path, log_format, n_jobs=-1, engine="regex",
+                                 encoding=None, typed=False, members="*"):
+    """Parallel version of preprocess_requests over a set of log files.
+
+    Plain files are split in newline aligned byte ranges which are parsed in
+    a pool of processes. Compressed files (.gz, .bz2, .xz) are decompressed
+    by the processes, and tar archives are read in place, their members
+    being parsed in parallel while the archive is decompressed. Results are
+    concatenated in file order, rotated files from oldest to newest.
+
+    Args:
+        path: Path, glob or list of paths/globs of log files or tar
+            archives (see open_request_logs).
+        log_format: See preprocess_requests.
+        n_jobs: Number of processes. -1 means one per CPU, 1 parses in the
+            current process.
+        engine: See preprocess_requests.
+        encoding: Text encoding of the file (default: same as open()).
+        typed: See preprocess_requests.
+        members: fnmatch pattern selecting the members of tar archives.
+
+    Returns:
+        pandas.DataFrame with the parsed data.
+
+    """
+    n_jobs = _effective_n_jobs(n_jobs)
+    paths = _expand_log_sources(path)
+    #Several ranges per process to even out the load
+    tasks = _log_tasks(paths, members, 1 if n_jobs == 1 else 4 * n_jobs,
+                       log_format, engine, encoding)
+    keys = []
+    def task_args():
+        for key, func, args in tasks:
+            keys.append(key)
+            yield (func, args)
+    if n_jobs == 1:
+        results = [_run_task(task) for task in task_args()]
+    else:
+        logging.info("Parsing %s with %d processes", path, n_jobs)
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(_imap_bounded(executor, _run_task, task_args(), 2 * n_jobs))
+    if len(results) == 0:
+        return preprocess_requests([], log_format, engine=engine, typed=typed)
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    X = pd.concat([results[i] for i in order], ignore_index=True)
+    #Converting after concat so that all the files share the categories
+    return _to_typed(X) if typed else X
+
+#Start of each bin of the idealized character distribution (ICD) over the
+#256 character frequencies sorted in descending order
+_ICD_BINS = np.array([0, 1, 4, 7, 12, 16])
+
+def _encode_urls(urls):
+    """Encodes a sequence of URLs into a single buffer of character codes.
+
+    Args:
+        urls: Iterable of str (e.g. the request_url column).
+
+    Returns:
+        Tuple (codes, lengths). codes is a 1-D numpy array with the character
+        codes of all the URLs concatenated, lengths holds the number of
+        characters of each URL.
+
+    """
+    urls = list(urls)
+    lengths = np.fromiter((len(url) for url in urls), dtype=np.int64,
+                          count=len(urls))
+    joined = ''.join(urls)
+    try:
+        codes = np.frombuffer(joined.encode('latin-1'), dtype=np.uint8)
+    except UnicodeEncodeError:
+        #Characters beyond 255 keep their position but are not counted
+        codes = np.frombuffer(joined.encode('utf-32-le'), dtype=np.uint32)
+    return codes, lengths
+
+def _char_histograms(codes, lengths, block_size=4096):
+    """Computes the 256-bin character histogram of each URL.
+
+    Rows are processed in blocks so that memory is bounded by block_size*256
+    counters regardless of the number of URLs.
+
+    Args:
+        codes, lengths: Output of _encode_urls.
+        block_size: Number of URLs per block.
+
+    Yields:
+        Tuples (start, hist) where hist is an array of shape (rows, 256)
+        with the histograms of URLs start, start+1, ..., start+rows-1.
+
+    """
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    for start in range(0, len(lengths), block_size):
+        stop = min(start + block_size, len(lengths))
+        block = codes[offsets[start]:offsets[stop]]
+        rows = np.repeat(np.arange(stop - start), lengths[start:stop])
+        if block.dtype != np.uint8:
+            valid = block < 256
+            block = block[valid]
+            rows = rows[valid]
+        hist = np.bincount(rows * 256 + block, minlength=(stop - start) * 256)
+        yield start, hist.reshape(stop - start, 256)
+
+def _char_freq_sum(codes, lengths, groups=None, n_groups=1):
+    """Adds up the relative character frequencies of non empty URLs.
+
+    Args:
+        codes, lengths: Output of _encode_urls.
+        groups: If given, the group of each URL (-1 for none), to add up
+            the frequencies of each of n_groups groups separately.
+
+    Returns:
+        Tuple (char_freq, count_non_empty), with char_freq the 256 sums of
+        relative frequencies indexed by character code. With groups, arrays
+        of shape (n_groups, 256) and (n_groups,).
+
+    """
+    if groups is None:
+        char_freq, count_non_empty = _char_freq_sum(
+            codes, lengths, np.zeros(len(lengths), dtype=np.int64))
+        return char_freq[0], int(count_non_empty[0])
+    char_freq = np.zeros((n_groups, 256))
+    count_non_empty = np.zeros(n_groups, dtype=np.int64)
+    for start, hist in _char_histograms(codes, lengths):
+        block_lengths = lengths[start:start + len(hist)]
+        block_groups = groups[start:start + len(hist)]
+        #Ignoring zero length strings / Avoiding division by zero
+        rows = np.flatnonzero((block_lengths > 0) & (block_groups >= 0))
+        if len(rows) == 0:
+            continue
+        #Rows sorted by group, adding up the runs of each group
+        rows = rows[np.argsort(block_groups[rows], kind="stable")]
+        block_groups = block_groups[rows]
+        starts = np.flatnonzero(np.concatenate(([True], np.diff(block_groups) != 0)))
+        char_freq[block_groups[starts]] += np.add.reduceat(
+            hist[rows] / block_lengths[rows, None], starts, axis=0)
+        count_non_empty += np.bincount(block_groups, minlength=n_groups)
+    return char_freq, count_non_empty
+
+def _icd_from_freq(char_freq, count_non_empty):
+    """Folds summed character frequencies into the idealized character
+    distribution (ICD).
+
+    Returns:
+        list with the 6 ICD values.
+
+    """
+    char_freq = np.sort(char_freq / count_non_empty)[::-1]
+    return np.add.reduceat(char_freq, _ICD_BINS).tolist()
+
+def _char_count_bins(codes, lengths):
+    """Sorts the character counts of each URL and folds them in the ICD bins.
+
+    Returns:
+        numpy array of shape (n_urls, 6) with the observed count in each bin.
+
+    """
+    bins = np.empty((len(lengths), len(_ICD_BINS)))
+    for start, hist in _char_histograms(codes, lengths):
+        hist.sort(axis=1)
+        bins[start:start + len(hist)] = np.add.reduceat(hist[:, ::-1], _ICD_BINS,
+                                                        axis=1)
+    return bins
+
+def _chisquare_pvalues(ccd_bins, lengths, icd):
+    """Pearson's chi-square test of each URL against the ICD.
+
+    Equivalent to calling scipy.stats.chisquare once per row with the
+    expected frequencies icd*length, computed for all the rows at once.
+
+    Args:
+        ccd_bins: Array of shape (n_urls, 6) with the observed bins
+            (see _char_count_bins).
+        lengths: Array of shape (n_urls,) with the URL lengths.
+        icd: The 6 values of the idealized character distribution.
+
+    Returns:
+        numpy array with the p-value of each URL. Zero length URLs get 0.0.
+
+    """
+    expected = np.outer(lengths, icd)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x2_values = ((ccd_bins - expected) ** 2 / expected).sum(axis=1)
+    pvalues = chdtrc(len(icd) - 1, x2_values)
+    pvalues[lengths == 0] = 0.0
+    return pvalues
+
+def normalize_paths(paths):
+    """Normalizes URL paths so that requests to the same endpoint share it.
+
+    Repeated slashes are collapsed, numeric segments are replaced by {id}
+    (e.g. /entry/15205 -> /entry/{id}) and trailing slashes are removed.
+
+    Args:
+        paths: pandas.Series of str.
+
+    Returns:
+        pandas.Series with the normalized paths.
+
+    """
+    paths = paths.str.replace(r'/{2,}', '/', regex=True)
+    paths = paths.str.replace(r'/\d+(?=/|$)', '/{id}', regex=True)
+    return paths.str.replace(r'(?<=.)/+$', '', regex=True)
+
+class RequestFeatureExtractor(BaseEstimator, TransformerMixin):
+    """Decomposes each request URL once into the columns read by the
+    attribute models of RequestAnomalyDetector.
+
+    The output of transform is a DataFrame with the index of X and columns:
+        request_url: the original URL.
+        length: number of characters of the URL.
+        path: path component of the URL.
+        param_list: tuple with the query parameter names, in order.
+        param_set: frozenset with the query parameter names.
+        param_values: tuple with the query parameter values, aligned with
+            param_list.
+        endpoint: normalized path (see normalize_paths).
+    Parameters with blank values are ignored, as in urllib.parse.parse_qsl.
+    """
+
+    def fit(self, X, y=None):
+        """Stateless, kept for compatibility with the transformer API."""
+        return self
+
+    def transform(self, X):
+        """ Extracts the URL features.
+        Parameters
+        ----------
+        X: DataFrame, shape (n_samples, n_features).
+        Must contain the request_url column.
+        """
+        urls = X["request_url"]
+        paths = []
+        param_lists = []
+        param_values = []
+        for url in urls:
+            split = urlparse.urlsplit(url)
+            params = urlparse.parse_qsl(split.query)
+            paths.append(split.path)
+            param_lists.append(tuple(p[0] for p in params))
+            param_values.append(tuple(p[1] for p in params))
+        features = pd.DataFrame(index=X.index)
+        features["request_url"] = urls
+        features["length"] = urls.str.len()
+        features["path"] = pd.Series(paths, index=X.index, dtype=object)
+        features["param_list"] = pd.Series(param_lists, index=X.index, dtype=object)
+        features["param_set"] = pd.Series([frozenset(l) for l in param_lists],
+                                          index=X.index, dtype=object)
+        features["param_values"] = pd.Series(param_values, index=X.index,
+                                             dtype=object)
+        features["endpoint"] = normalize_paths(features["path"])
+        return features
+
+class RequestFeatureVectorizer(BaseEstimator, TransformerMixin):
+    """Sparse per-request feature matrix for sklearn estimators.
+
+    The output of transform is a scipy.sparse CSR matrix with one row per
+    request and the column blocks:
+        param names: n_param_features columns, presence of the query
+            parameter names hashed with FeatureHasher.
+        param order: n_order_features columns, presence of each pair of
+            consecutive parameter names (the first one paired with "^").
+        icd: 6 columns, fraction of the characters of the URL in each bin
+            of the idealized character distribution.
+        length: 1 column, number of characters of the URL.
+        status: 5 columns (1xx to 5xx), one-hot class of the status code,
+            if X has a status column and status is True.
+    Hashing keeps the number of columns fixed whatever the number of
+    parameter names, and the memory proportional to the non-zeros.
+
+    Parameters
+    ----------
+    n_param_features: int, default: 1024
+        Number of columns of the parameter name block.
+    n_order_features: int, default: 1024
+        Number of columns of the parameter order block.
+    status: bool, default: True
+        Whether to add the status block.
+    """
+
+    def __init__(self, n_param_features=1024, n_order_features=1024, status=True):
+        self.n_param_features = n_param_features
+        self.n_order_features = n_order_features
+        self.status = status
+
+    def fit(self, X, y=None):
+        """Stateless, kept for compatibility with the transformer API."""
+        return self
+
+    def transform(self, X):
+        """ Builds the feature matrix.
+        Parameters
+        ----------
+        X: DataFrame, shape (n_samples, n_features).
+        Must contain the request_url column (and status for the status
+        block).
+        """
+        features = RequestFeatureExtractor().transform(X[["request_url"]])
+        names = FeatureHasher(n_features=self.n_param_features, input_type="string",
+                              alternate_sign=False).transform(features["param_set"])
+        order = FeatureHasher(n_features=self.n_order_features, input_type="string",
+                              alternate_sign=False).transform(
+                                  [a + ">" + b for a, b in zip(("^",) + keys, keys)]
+                                  for keys in features["param_list"])
+        codes, lengths = _encode_urls(features["request_url"])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            icd = np.nan_to_num(_char_count_bins(codes, lengths) / lengths[:, None])
+        blocks = [names, order, sp.csr_matrix(np.column_stack([icd, lengths]))]
+        if self.status:
+            blocks.append(self._status_block(X))
+        return sp.hstack(blocks, format="csr")
+
+    def _status_block(self, X):
+        if "status" not in X:
+            return sp.csr_matrix((len(X), 5))
+        classes = pd.to_numeric(X["status"], errors="coerce").to_numpy(
+            dtype=float, na_value=np.nan) // 100
+        rows = np.flatnonzero((classes >= 1) & (classes <= 5))
+        return sp.csr_matrix((np.ones(len(rows)), (rows, classes[rows].astype(int) - 1)),
+                             shape=(len(X), 5))
+
+    def get_feature_names_out(self, input_features=None):
+        """ Names of the columns of the output of transform.
+        """
+        names = ["param_name_%d" % i for i in range(self.n_param_features)]
+        names += ["param_order_%d" % i for i in range(self.n_order_features)]
+        names += ["icd_%d" % i for i in range(len(_ICD_BINS))] + ["length"]
+        if self.status:
+            names += ["status_%dxx" % i for i in range(1, 6)]
+        return np.asarray(names, dtype=object)
+
+class RequestModelSummary(object):
+    """Sufficient statistics of the attribute models of RequestAnomalyDetector.
+
+    Summaries of disjoint sets of requests (e.g. computed by different
+    processes or map-reduce workers) can be merged into the summary of their
+    union, which gives the same models as a global fit.
+
+    Attributes:
+        count: Number of requests.
+        length_mean, length_m2: Mean and sum of squared deviations of the
+            URI lengths (merged with the parallel Welford algorithm).
+        char_freq: Sums of the relative character frequencies of non empty
+            URIs, indexed by character code.
+        count_non_empty: Number of non empty URIs.
+        param_sets, param_lists: Counters of the sets/lists of parameter
+            names.
+        paths: dict from endpoint (see normalize_paths) to the
+            RequestModelSummary of its requests. At most max_paths endpoints
+            are tracked, in order of first appearance. Merging summaries
+            whose endpoints exceed max_paths keeps the ones already tracked
+            by self, so it only matches a global fit below the cap.
+    """
+
+    def __init__(self, max_paths=0):
+        self.max_paths = max_paths
+        self.paths = {}
+        self.count = 0
+        self.length_mean = 0.0
+        self.length_m2 = 0.0
+        self.char_freq = np.zeros(256)
+        self.count_non_empty = 0
+        self.param_sets = Counter()
+        self.param_lists = Counter()
+
+    def update(self, features, profiler=NULL_PROFILER):
+        """Adds the requests in features (see RequestFeatureExtractor).
+        The stages of the computation are recorded by profiler (see
+        BaseAnomalyDetector.enable_profiling)."""
+        chunk = RequestModelSummary()
+        lengths = features["length"].to_numpy(dtype=float)
+        if len(lengths) == 0:
+            return self
+        with profiler.stage("length", len(lengths)):
+            chunk.count = len(lengths)
+            chunk.length_mean = lengths.mean()
+            chunk.length_m2 = ((lengths - chunk.length_mean) ** 2).sum()
+        if self.max_paths > 0:
+            groups, endpoints = self._admit_paths(features["endpoint"])
+        with profiler.stage("char-distribution", len(lengths)):
+            codes, url_lengths = _encode_urls(features["request_url"])
+            if self.max_paths > 0:
+                #One pass for the global and per-endpoint frequencies: the
+                #requests of endpoints not admitted go to a last group
+                char_freqs, counts_non_empty = _char_freq_sum(
+                    codes, url_lengths, np.where(groups >= 0, groups, len(endpoints)),
+                    len(endpoints) + 1)
+                chunk.char_freq = char_freqs.sum(axis=0)
+                chunk.count_non_empty = int(counts_non_empty.sum())
+            else:
+                chunk.char_freq, chunk.count_non_empty = _char_freq_sum(codes, url_lengths)
+        with profiler.stage("params", len(lengths)):
+            chunk.param_sets.update(keys_set for keys_set in features["param_set"]
+                                    if len(keys_set) > 0)
+            chunk.param_lists.update(features["param_list"])
+        if self.max_paths > 0:
+            with profiler.stage("paths", len(lengths)):
+                chunk.paths = self._path_summaries(features, lengths, groups, endpoints,
+                                                   char_freqs, counts_non_empty)
+        return self.merge(chunk)
+
+    def _admit_paths(self, endpoints):
+        """Endpoints of a chunk with their own summary: the tracked ones and
+        the first new ones up to max_paths, in order of first appearance.
+
+        Returns:
+            Tuple (groups, admitted): position in admitted of the endpoint of
+            each request (-1 if not admitted) and the admitted endpoints.
+
+        """
+        groups, uniques = pd.factorize(endpoints, sort=False)
+        budget = self.max_paths - len(self.paths)
+        admitted = np.zeros(len(uniques), dtype=bool)
+        for i, endpoint in enumerate(uniques):
+            if endpoint in self.paths:
+                admitted[i] = True
+            elif budget > 0:
+                admitted[i] = True
+                budget -= 1
+        renumber = np.where(admitted, np.cumsum(admitted) - 1, -1)
+        return renumber[groups], uniques[admitted]
+
+    def _path_summaries(self, features, lengths, groups, endpoints, char_freqs,
+                        counts_non_empty):
+        """Summaries of the admitted endpoints (see _admit_paths), from the
+        lengths and character frequencies already computed for the chunk."""
+        rows = np.flatnonzero(groups >= 0)
+        row_groups = groups[rows]
+        counts = np.bincount(row_groups, minlength=len(endpoints))
+        means = np.bincount(row_groups, lengths[rows], minlength=len(endpoints)) / \
+            np.maximum(counts, 1)
+        m2s = np.bincount(row_groups, (lengths[rows] - means[row_groups]) ** 2,
+                          minlength=len(endpoints))
+        #Requests of each endpoint, for the parameter counters
+        order = rows[np.argsort(row_groups, kind="stable")]
+        bounds = np.concatenate(([0], np.cumsum(counts)))
+        param_sets = features["param_set"].to_numpy()
+        param_lists = features["param_list"].to_numpy()
+        result = {}
+        for i, endpoint in enumerate(endpoints):
+            summary = result[endpoint] = RequestModelSummary()
+            positions = order[bounds[i]:bounds[i + 1]]
+            summary.count = int(counts[i])
+            summary.length_mean = means[i]
+            summary.length_m2 = m2s[i]
+            summary.char_freq = char_freqs[i]
+            summary.count_non_empty = int(counts_non_empty[i])
+            summary.param_sets.update(keys_set for keys_set in param_sets[positions]
+                                      if len(keys_set) > 0)
+            summary.param_lists.update(param_lists[positions])
+        return result
+
+    def merge(self, other):
+        """Adds the requests summarized in other (in place)."""
+        count = self.count + other.count
+        if count == 0:
+            return self
+        delta = other.length_mean - self.length_mean
+        self.length_m2 += other.length_m2 + delta ** 2 * self.count * other.count / count
+        self.length_mean += delta * other.count / count
+        self.count = count
+        self.char_freq = self.char_freq + other.char_freq
+        self.count_non_empty += other.count_non_empty
+        self.param_sets.update(other.param_sets)
+        self.param_lists.update(other.param_lists)
+        for endpoint, summary in other.paths.items():
+            if endpoint in self.paths:
+                self.paths[endpoint].merge(summary)
+            elif len(self.paths) < self.max_paths:
+                self.paths[endpoint] = RequestModelSummary().merge(summary)
+        return self
+
+    def models(self):
+        """Builds the attribute models (see RequestAnomalyDetector.attribute_models_)."""
+        mean = np.float64(self.length_mean) if self.count > 0 else np.nan
+        std = np.sqrt(self.length_m2 / (self.count - 1)) if self.count > 1 else np.nan
+        return {"uri_length": (mean, std),
+                #Calculate idealized character distribution (ICD)
+                "icd": _icd_from_freq(self.char_freq, self.count_non_empty),
+                #Counters keyed by frozenset/tuple of parameter names (O(1) lookups)
+                "param_sets": self.param_sets,
+                "param_lists": self.param_lists}
+
+def summarize_requests(X, max_paths=0, profiler=NULL_PROFILER):
+    """Computes the RequestModelSummary of a DataFrame of requests.
+
+    This is the map step of a sharded fit: the summaries of disjoint slices
+    are reduced with combine_summaries and loaded with
+    RequestAnomalyDetector.fit_summary.
+    """
+    summary = RequestModelSummary(max_paths=max_paths)
+    with profiler.stage("features", len(X)):
+        features = RequestFeatureExtractor().transform(X)
+    return summary.update(features, profiler)
+
+def combine_summaries(summaries, max_paths=0):
+    """Merges an iterable of RequestModelSummary into a new one."""
+    result = RequestModelSummary(max_paths=max_paths)
+    for summary in summaries:
+        result.merge(summary)
+    return result
+
+#Columns of the score matrix of RequestAnomalyDetector: flags of anomalous
+#length, set and list of parameters, and the character distribution p-value
+SCORE_COLUMNS = ["uri_length", "pvalue", "param_sets", "param_lists"]
+
+#Statistics of the URL score cache of RequestAnomalyDetector
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
 
 class RequestAnomalyDetector(BaseEstimator, ClusterMixin, BaseAnomalyDetector):
     """Request anomaly detector.
     Parameters
     ----------
+    min_param_count: int, default: 1
+        Sets and lists of parameters seen fewer times than this during fit
+        are reported as anomalous.
+    n_jobs: int, default: None
+        Number of processes used by fit. None means 1, -1 means using all
+        the CPUs.
+    max_paths: int, default: 0
+        Maximum number of endpoints (normalized request paths) with their
+        own attribute models. 0 disables per-endpoint models.
+    min_path_count: int, default: 10
+        Endpoints with fewer training requests are checked against the
+        global models.
+    cache_size: int, default: 0
+        Maximum number of URLs whose results are kept in a LRU cache across
+        predict calls (useful when scoring streams). 0 disables the cache,
+        which is cleared whenever the model changes.
+    n_clusters: int, default: 2
+        Number of clusters of the clustering stage (see fit_clusters).
+    cluster_batch_size: int, default: 1024
+        Size of the mini-batches of the clustering stage.
+    random_state: int, RandomState instance or None, default: None
+        Seed of the clustering stage.
+    alpha: float, default: 0.01
+        Requests with a lower character distribution p-value are anomalous
+        for decision_function (and RequestLogFollower).
+    store_predict_results: bool, default: False
+        Whether predict keeps the score matrix of its last call in
+        predict_results_ (used by kmeans() without arguments). Results are
+        never stored in attribute_models_.
    """
-    all_ascii = ''.join([chr(x) for x in range(256)])
 
-    def __init__(self):
+    def __init__(self, min_param_count=1, n_jobs=None, max_paths=0,
+                 min_path_count=10, cache_size=0, n_clusters=2,
+                 cluster_batch_size=1024, random_state=None, alpha=0.01,
+                 store_predict_results=False):
+        self.min_param_count = min_param_count
+        self.n_jobs = n_jobs
+        self.max_paths = max_paths
+        self.min_path_count = min_path_count
+        self.cache_size = cache_size
+        self.n_clusters = n_clusters
+        self.cluster_batch_size = cluster_batch_size
+        self.random_state = random_state
+        self.alpha = alpha
+        self.store_predict_results = store_predict_results
         self.attribute_models_ = {}
+        self.predict_results_ = None
+        self.stats_ = None
+        self.score_cache_ = OrderedDict()
+        self.cache_hits_ = 0
+        self.cache_misses_ = 0
+        self.clusterer_ = None
         self.kmeans_labels = None
         return
 
@@ -63,60 +929,88 @@ class RequestAnomalyDetector(BaseEstimator, ClusterMixin, BaseAnomalyDetector):
         """ Create normal model for Web requests.
         Parameters
         ----------
-        X: DataFrame, shape (n_samples, n_features).
+        X: DataFrame, shape (n_samples, n_features), or an iterable of
+        DataFrames (e.g. from preprocess_requests_chunks) which are processed
+        one at a time.
         Features are characteristics of the requests.
         """
         #TODO: Add other attributes of Web traffic.
-        # Get mean and std
-        lengths = X["request_url"].str.len()
-        self.attribute_models_["uri_length"] = (lengths.mean(), lengths.std())
-
-        #Verifying character distribution
-        char_freq = []
-        for i in range(256):
-            char_freq.append(0.0)
-        count_non_empty = 0
-        for index, row in X.iterrows():
-            #Ignoring zero length strings / Avoiding division by zero
-            if len(row.request_url) == 0:
-                continue
-            for i in range(256):
-                freq = float(row.request_url.count(self.all_ascii[i])) / len(row.request_url)
-                char_freq[i] += freq
-            count_non_empty += 1
-            if index % 1000 == 0:
-                logging.info('RequestAnomalyDetector - fit - char dist: Processed \
-                             %d requests', index)
-        for i in range(256):
-            char_freq[i] /= count_non_empty
-        char_freq.sort(reverse=True)
-        #Calculate idealized character distribution (ICD)
-        icd = [char_freq[0]]
-        icd.append(sum(char_freq[1:4]))
-        icd.append(sum(char_freq[4:7]))
-        icd.append(sum(char_freq[7:12]))
-        icd.append(sum(char_freq[12:16]))
-        icd.append(sum(char_freq[16:256]))
-        self.attribute_models_["icd"] = icd
-
-        ##Verifying distinct sets and lists of parameters
-        param_sets = []
-        param_lists = []
-        for index, row in X.iterrows():
-            params = urlparse.parse_qs(urlparse.urlsplit(row.request_url).query)
-            if len(params) > 0:
-                keys_set = set(params.keys())
-                if keys_set not in param_sets:
-                    param_sets.append(set(params.keys()))
-            params = urlparse.parse_qsl(urlparse.urlsplit(row.request_url).query)
-            param_list = [p[0] for p in params]
-            if param_list not in param_lists:
-                param_lists.append(param_list)
-        self.attribute_models_["param_sets"] = param_sets
-        self.attribute_models_["param_lists"] = param_lists
+        n_jobs = _effective_n_jobs(self.n_jobs)
+        if isinstance(X, pd.DataFrame):
+            #One slice per process
+            bounds = np.linspace(0, len(X), n_jobs + 1).astype(int)
+            X = [X.iloc[start:stop] for start, stop in zip(bounds, bounds[1:])]
+        summary = RequestModelSummary(max_paths=self.max_paths)
+        summarize = functools.partial(summarize_requests, max_paths=self.max_paths)
+        profiler = self.profiler_ or NULL_PROFILER
+        with profiler.stage("fit") as stage:
+            if n_jobs == 1:
+                for chunk in X:
+                    summary.merge(summarize(chunk, profiler=profiler))
+                    logging.info('RequestAnomalyDetector - fit: Processed %d requests',
+                                 summary.count)
+            else:
+                #The stages run by the other processes are not recorded
+                with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                    for chunk_summary in _imap_bounded(executor, summarize, X, 2 * n_jobs):
+                        summary.merge(chunk_summary)
+                        logging.info('RequestAnomalyDetector - fit: Processed %d requests',
+                                     summary.count)
+            stage.rows = summary.count
+        return self.fit_summary(summary)
+
+    def partial_fit(self, X, y=None):
+        """ Updates the normal model with a new chunk of Web requests.
+        The resulting model is the same as a fit() over all the chunks seen
+        since the last fit() (or since the creation of the detector).
+        Parameters
+        ----------
+        X: DataFrame, shape (n_samples, n_features).
+        Features are characteristics of the requests.
+        """
+        if self.stats_ is None:
+            self.stats_ = RequestModelSummary(max_paths=self.max_paths)
+        profiler = self.profiler_ or NULL_PROFILER
+        with profiler.stage("fit", len(X)):
+            self.stats_.merge(summarize_requests(X, max_paths=self.max_paths,
+                                                 profiler=profiler))
+        logging.info('RequestAnomalyDetector - partial_fit: Processed %d requests',
+                     self.stats_.count)
+        self._set_models()
 
         return self
 
+    def fit_summary(self, summary):
+        """ Create normal model from a RequestModelSummary (e.g. the
+        combine_summaries of the summarize_requests of several shards).
+        """
+        self.stats_ = summary
+        self._set_models()
+
+        return self
+
+    def _set_models(self):
+        self.attribute_models_.update(self.stats_.models())
+        #Per endpoint models, only for endpoints with enough requests
+        self.attribute_models_["paths"] = {
+            endpoint: summary.models() for endpoint, summary in self.stats_.paths.items()
+            if summary.count >= self.min_path_count}
+        self.clear_cache()
+
+    def clear_cache(self):
+        """ Empties the URL score cache and resets its counters.
+        """
+        self.score_cache_ = OrderedDict()
+        self.cache_hits_ = 0
+        self.cache_misses_ = 0
+
+    def cache_info(self):
+        """ Returns the CacheInfo(hits, misses, maxsize, currsize) of the URL
+        score cache.
+        """
+        return CacheInfo(self.cache_hits_, self.cache_misses_, self.cache_size,
+                         len(self.score_cache_))
+
     def predict(self, X):
         """ Checks new data against the normal model.
         Parameters
@@ -125,93 +1019,205 @@ class RequestAnomalyDetector(BaseEstimator, ClusterMixin, BaseAnomalyDetector):
         Features are characteristics of the requests.
         New data to check.
         """
-        result = []
-        #Temporary list to feed the final DataFrame (Performance)
-        uri_length_lst = []
-        try:
-            norm_model = self.attribute_models_["uri_length"]
-        except AttributeError:
-            logging.warning('RequestAnomalyDetector: call to preditct() without previous fit()')
+        if not self._is_fitted():
+            logging.warning('RequestAnomalyDetector: call to predict() without previous fit()')
             return None
+        scores = self.score_matrix(X)
+        if self.store_predict_results:
+            self.predict_results_ = scores
 
-        #Checking URI length
-        for index, row in X.iterrows():
-            # TODO: Check more anomaly models
-            if len(row.request_url) > norm_model[0] + 2*norm_model[1]:
-                uri_length_lst.append(1)
+        return self.score_frame(scores, X.index)
+
+    def _is_fitted(self):
+        return "uri_length" in self.attribute_models_
+
+    def score_matrix(self, X, as_frame=False):
+        """ Checks new data against the normal model.
+        Returns an array of shape (n_samples, 4) with the results of each
+        attribute model (see SCORE_COLUMNS), or a DataFrame like predict if
+        as_frame is True.
+        """
+        if not self._is_fitted():
+            raise ValueError("RequestAnomalyDetector not fitted, call fit first")
+        with self.profile_stage("predict", len(X)):
+            scores = self._score(X)
+        if as_frame:
+            return self.score_frame(scores, X.index)
+        return scores
+
+    def score_samples(self, X, scores=None):
+        """ Normality score of each request (the lower, the more abnormal):
+        the p-value of its character distribution minus the number of the
+        other attribute models which flag it. Undefined p-values (NaN, when
+        the ICD has empty bins) count as 1. scores is the score_matrix of X,
+        if already computed.
+        """
+        if scores is None:
+            scores = self.score_matrix(X)
+        return np.nan_to_num(scores[:, 1], nan=1.0) - scores[:, [0, 2, 3]].sum(axis=1)
+
+    def decision_function(self, X, scores=None):
+        """ score_samples shifted by alpha: negative for anomalous requests
+        (p-value below alpha or flagged by another attribute model).
+        """
+        return self.score_samples(X, scores) - self.alpha
+
+    @staticmethod
+    def score_frame(scores, index=None):
+        """ DataFrame of a score matrix (see score_matrix), with int flags.
+        """
+        return pd.DataFrame({"uri_length": scores[:, 0].astype(int),
+                             "pvalue": scores[:, 1],
+                             "param_sets": scores[:, 2].astype(int),
+                             "param_lists": scores[:, 3].astype(int)},
+                            index=index, columns=SCORE_COLUMNS)
+
+    def _score(self, X):
+        """Results of the requests in X as an array of shape (len(X), 4)
+        (see _score_urls)."""
+        #Every attribute depends on the URL only: scoring each distinct URL once
+        positions, urls = pd.factorize(X["request_url"])
+        urls = np.asarray(urls, dtype=object)
+        if self.cache_size > 0:
+            scores = self._score_urls_cached(urls)
+        else:
+            scores = self._score_urls(urls)
+        return scores.take(positions, axis=0)
+
+    def _score_urls_cached(self, urls):
+        """_score_urls through the LRU cache."""
+        scores = np.empty((len(urls), 4))
+        misses = []
+        for i, url in enumerate(urls):
+            cached = self.score_cache_.get(url)
+            if cached is None:
+                misses.append(i)
             else:
-                uri_length_lst.append(0)
+                self.score_cache_.move_to_end(url)
+                scores[i] = cached
+        self.cache_hits_ += len(urls) - len(misses)
+        self.cache_misses_ += len(misses)
+        if len(misses) > 0:
+            scores[misses] = self._score_urls(urls[misses])
+            for i in misses:
+                self.score_cache_[urls[i]] = scores[i].copy()
+            while len(self.score_cache_) > self.cache_size:
+                self.score_cache_.popitem(last=False)
+        return scores
+
+    def _score_urls(self, urls):
+        """Checks URLs against the models. Returns an array of shape
+        (len(urls), 4) with the uri_length, pvalue, param_sets and
+        param_lists results."""
+        urls = pd.DataFrame({"request_url": pd.Series(urls, dtype=object)})
+        with self.profile_stage("features", len(urls)):
+            features = RequestFeatureExtractor().transform(urls)
+        #Routing each request to the models of its endpoint (or the global ones)
+        path_models = self.attribute_models_.get("paths", {})
+        if len(path_models) > 0:
+            routed = features["endpoint"].where(features["endpoint"].isin(path_models))
+            groups = features.groupby(routed, sort=False, dropna=False).indices
+        else:
+            groups = {np.nan: np.arange(len(features))}
+        if len(groups) == 1:
+            endpoint = next(iter(groups))
+            return self._check_models(features, path_models.get(endpoint,
+                                                                self.attribute_models_))
+        scores = np.empty((len(features), len(SCORE_COLUMNS)))
+        for endpoint, positions in groups.items():
+            models = path_models.get(endpoint, self.attribute_models_)
+            scores[positions] = self._check_models(features.iloc[positions], models)
+        return scores
 
-        anomalous = pd.DataFrame(index=X.index, data=uri_length_lst,
-                                 columns=["uri_length"])
-        result.append(anomalous.copy())
+    def _check_models(self, features, models):
+        """Checks the features of some requests against a set of attribute
+        models. Returns the uri_length, pvalue, param_sets and param_lists
+        results as the columns of an array."""
+        scores = np.empty((len(features), len(SCORE_COLUMNS)))
+        #Checking URI length
+        # TODO: Check more anomaly models
+        with self.profile_stage("length", len(features)):
+            norm_model = models["uri_length"]
+            np.greater(features["length"].to_numpy(), norm_model[0] + 2*norm_model[1],
+                       out=scores[:, 0])
 
         #Checking character distribution
-        char_dist_lst = []
-        icd = self.attribute_models_["icd"]
-        for index, row in X.iterrows():
-            char_freq = []
-            if len(row.request_url) == 0:
-                char_dist_lst.append(0.0)
-                continue
-            for i in range(256):
-                char_count = row.request_url.count(self.all_ascii[i])
-                char_freq.append(char_count)
-            char_freq.sort(reverse=True)
-            ccd = [char_freq[0]]
-            ccd.append(sum(char_freq[1:4]))
-            ccd.append(sum(char_freq[4:7]))
-            ccd.append(sum(char_freq[7:12]))
-            ccd.append(sum(char_freq[12:16]))
-            ccd.append(sum(char_freq[16:256]))
-
-            #Computing x^2 value
-            x2_value = chisquare(ccd, [icd[i]*len(row.request_url) for i in
-                                 (0, 1, 2, 3, 4, 5)])
-            char_dist_lst.append(x2_value.pvalue)
-        anomalous = pd.DataFrame(index=X.index, data=char_dist_lst, columns=["pvalue"])
-        result.append(anomalous.copy())
+        with self.profile_stage("char-distribution", len(features)):
+            codes, lengths = _encode_urls(features["request_url"])
+            ccd_bins = _char_count_bins(codes, lengths)
+        #Computing x^2 value
+        with self.profile_stage("chi-square", len(features)):
+            scores[:, 1] = _chisquare_pvalues(ccd_bins, lengths, models["icd"])
 
         #Checking sets and lists of parameters
-        param_sets_lst = []
-        param_lists_lst = []
-        for index, row in X.iterrows():
-            params = urlparse.parse_qs(urlparse.urlsplit(row.request_url).query)
-            detected = 0
-            if len(params) > 0:
-                keys_set = set(params.keys())
-                if keys_set not in self.attribute_models_["param_sets"]:
-                    detected = 1
-            param_sets_lst.append(detected)
-
-            params = urlparse.parse_qsl(urlparse.urlsplit(row.request_url).query)
-            detected = 0
-            if len(params) > 0:
-                param_list = [p[0] for p in params]
-                if param_list not in self.attribute_models_["param_lists"]:
-                    detected = 1
-            param_lists_lst.append(detected)
-
-        anomalous = pd.DataFrame(index=X.index, data=param_sets_lst,
-                                 columns=["param_sets"])
-        result.append(anomalous.copy())
-
-        anomalous = pd.DataFrame(index=X.index, data=param_sets_lst,
-                                 columns=["param_lists"])
-        result.append(anomalous.copy())
-
-        result_df = pd.concat(result, axis=1)
-        self.attribute_models_["predict_results"] = result_df
-
-        return result_df
-
-    def kmeans(self):
-        """ Applies kmeans over the predicted attributes.
+        with self.profile_stage("params", len(features)):
+            scores[:, 2] = self._rare_keys(features["param_set"], models["param_sets"])
+            scores[:, 3] = self._rare_keys(features["param_list"], models["param_lists"])
+        return scores
+
+    def _rare_keys(self, keys, counts):
+        """Flags the non empty keys (sets or lists of parameter names) seen
+        fewer than min_param_count times. Each distinct key is looked up
+        once."""
+        positions, uniques = pd.factorize(keys)
+        rare = np.fromiter((len(key) > 0 and counts[key] < self.min_param_count
+                            for key in uniques), dtype=bool, count=len(uniques))
+        return rare[positions]
+
+    def _new_clusterer(self):
+        return MiniBatchKMeans(n_clusters=self.n_clusters,
+                               batch_size=self.cluster_batch_size,
+                               random_state=self.random_state)
+
+    def fit_clusters(self, X=None):
+        """ Fits the clustering stage over the results of the requests.
+        Parameters
+        ----------
+        X: DataFrame, shape (n_samples, n_features), default: None
+        Requests to score and cluster. By default, the results of the last
+        predict (see store_predict_results).
         """
-        kmeans = KMeans(n_clusters=2)
-        X = self.attribute_models_["predict_results"]
-        kmeans.fit(X)
+        results = self._cluster_input(X)
+        with self.profile_stage("clustering", len(results)):
+            self.clusterer_ = self._new_clusterer().fit(results)
+        return self
 
-        self.kmeans_labels = kmeans.predict(X)
+    def partial_fit_clusters(self, X):
+        """ Updates the clustering stage with the results of a new batch of
+        requests (the first call fits it).
+        """
+        if self.clusterer_ is None:
+            self.clusterer_ = self._new_clusterer()
+        results = self._cluster_input(X)
+        with self.profile_stage("clustering", len(results)):
+            self.clusterer_.partial_fit(results)
+        return self
+
+    def predict_clusters(self, X):
+        """ Assigns the requests of a new batch to the fitted clusters.
+        Returns an array with the label of each request.
+        """
+        if self.clusterer_ is None:
+            raise ValueError("Clustering stage not fitted, call fit_clusters first")
+        results = self._cluster_input(X)
+        with self.profile_stage("clustering", len(results)):
+            return self.clusterer_.predict(results)
+
+    def _cluster_input(self, X):
+        if X is not None:
+            return self._score(X)
+        if self.predict_results_ is None:
+            raise ValueError("No stored predict results, pass the requests to "
+                             "cluster or set store_predict_results")
+        return self.predict_results_
+
+    def kmeans(self, X=None):
+        """ Applies kmeans over the predicted attributes.
+        The clustering stage is fitted over the results of the requests in X
+        (by default, the stored results of the last predict), and the labels
+        of those results are returned.
+        """
+        self.fit_clusters(X)
+        self.kmeans_labels = self.clusterer_.labels_
 
         return self.kmeans_labels
@@ -0,0 +1,327 @@
+"""
+Real-time scoring of webserver log files as they are written.
+"""
+
+import asyncio
+import logging
+import os
+import pandas as pd
+from apache_log_parser import LineDoesntMatchException
+from .classes import preprocess_requests, _LOG_REGEXES
+
+class _FileFollower(object):
+    """Reads the lines appended to a file, following it across rotations
+    (the path gets a new inode) and truncations (the file shrinks)."""
+
+    def __init__(self, path, from_start=False, read_size=1 << 20):
+        self.path = path
+        self.read_size = read_size
+        self.rotations = 0
+        self.truncations = 0
+        self._handle = None
+        self._partial = b""
+        self._open(from_start)
+
+    def _open(self, from_start):
+        try:
+            self._handle = open(self.path, 'rb')
+        except FileNotFoundError:
+            self._handle = None
+            return
+        if not from_start:
+            self._handle.seek(0, os.SEEK_END)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def read_lines(self):
+        """Complete lines appended since the last call (at most read_size
+        bytes, unless the file was rotated)."""
+        if self._handle is None:
+            #Waiting for the file to be created (new files are read entirely)
+            self._open(True)
+            if self._handle is None:
+                return []
+        data = self._handle.read(self.read_size)
+        rotated = False
+        if len(data) < self.read_size:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                stat = None
+            if stat is None or stat.st_ino != os.fstat(self._handle.fileno()).st_ino:
+                #Rotated: the old file was read to the end, the new one is
+                #read from its start
+                logging.info("Log file rotated: %s", self.path)
+                self.rotations += 1
+                rotated = True
+                self.close()
+                self._open(True)
+            elif stat.st_size < self._handle.tell():
+                logging.info("Log file truncated: %s", self.path)
+                self.truncations += 1
+                self._handle.seek(0)
+                self._partial = b""
+                data = self._handle.read(self.read_size)
+        data = self._partial + data
+        end = data.rfind(b"\n") + 1
+        self._partial = data[end:]
+        lines = data[:end].splitlines(keepends=True)
+        if rotated and len(self._partial) > 0:
+            #Last line of the old file, without its newline
+            lines.append(self._partial)
+            self._partial = b""
+        return lines
+
+class RequestLogFollower(object):
+    """Follows webserver log files and scores the new requests in
+    micro-batches with a fitted RequestAnomalyDetector.
+
+    Lines are parsed as in preprocess_requests. Anomalous requests are passed
+    to the callback (a function or a coroutine function) and to the
+    iterators over the follower (`async for anomalies in follower`), as a
+    DataFrame with the parsed request, the results of the detector and the
+    source file.
+
+    Parameters
+    ----------
+    detector: RequestAnomalyDetector
+        Fitted detector. Requests with a negative decision_function (see
+        its alpha) are reported as anomalous. Its cache_size is worth
+        setting, as streams repeat many URLs.
+    paths: str or list of str
+        Log files to follow.
+    log_format: str, default: "Combined"
+        See preprocess_requests.
+    callback: callable, default: None
+        Called with the DataFrame of anomalous requests of each batch.
+    batch_size: int, default: 5000
+        Maximum number of lines per batch.
+    flush_interval: float, default: 0.2
+        Maximum seconds a line waits for its batch to fill.
+    poll_interval: float, default: 0.05
+        Seconds between checks of files without new lines.
+    from_start: bool, default: False
+        If True, existing lines are also scored. Otherwise only the lines
+        written after the start are.
+    max_queue: int, default: 64
+        Maximum number of reads waiting to be scored. Readers wait for the
+        scorer when it is reached.
+    encoding: str, default: "utf-8"
+        Text encoding of the logs.
+    """
+
+    def __init__(self, detector, paths, log_format="Combined", callback=None,
+                 batch_size=5000, flush_interval=0.2, poll_interval=0.05,
+                 from_start=False, max_queue=64, encoding="utf-8"):
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        self.detector = detector
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self.log_format = log_format
+        self.callback = callback
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self.from_start = from_start
+        self.max_queue = max_queue
+        self.encoding = encoding
+        self._followers = []
+        self._outputs = []
+        self._stopping = None
+        self._running = False
+        self._reset_metrics()
+
+    def _reset_metrics(self):
+        self.lines_read_ = 0
+        self.lines_scored_ = 0
+        self.lines_skipped_ = 0
+        self.anomalies_ = 0
+        self.batches_ = 0
+        self.queue_depth_ = 0
+        self.max_queue_depth_ = 0
+        self.last_batch_latency_ = 0.0
+        self.max_batch_latency_ = 0.0
+        self.total_batch_latency_ = 0.0
+
+    def metrics(self):
+        """ Returns a dict with the counters of the follower. Batch latency
+        is the time from the read of the oldest line of a batch to the
+        delivery of its anomalies, in seconds. Queue depth is the number of
+        lines read and not scored yet.
+        """
+        return {
+            "lines_read": self.lines_read_,
+            "lines_scored": self.lines_scored_,
+            "lines_skipped": self.lines_skipped_,
+            "anomalies": self.anomalies_,
+            "batches": self.batches_,
+            "queue_depth": self.queue_depth_,
+            "max_queue_depth": self.max_queue_depth_,
+            "last_batch_latency": self.last_batch_latency_,
+            "mean_batch_latency": self.total_batch_latency_ / max(self.batches_, 1),
+            "max_batch_latency": self.max_batch_latency_,
+            "rotations": sum(f.rotations for f in self._followers),
+            "truncations": sum(f.truncations for f in self._followers),
+        }
+
+    def stop(self):
+        """ Stops following the files. Lines already read are still scored
+        before run() returns.
+        """
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def run(self):
+        """ Follows the files until stop() is called.
+        """
+        if self._running:
+            raise RuntimeError("RequestLogFollower is already running")
+        self._running = True
+        self._stopping = asyncio.Event()
+        self._reset_metrics()
+        self._followers = [_FileFollower(path, self.from_start) for path in self.paths]
+        queue = asyncio.Queue(maxsize=self.max_queue)
+        scorer = asyncio.ensure_future(self._score_loop(queue))
+        try:
+            await asyncio.gather(*[self._read_loop(follower, queue)
+                                   for follower in self._followers])
+            await queue.put(None)
+            await scorer
+        finally:
+            scorer.cancel()
+            for follower in self._followers:
+                follower.close()
+            for output in self._outputs:
+                output.put_nowait(None)
+            self._running = False
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        """Yields the anomalies of each batch, running the follower if it
+        is not already running."""
+        output = asyncio.Queue()
+        self._outputs.append(output)
+        task = None if self._running else asyncio.ensure_future(self.run())
+        try:
+            while True:
+                anomalies = await output.get()
+                if anomalies is None:
+                    break
+                yield anomalies
+        finally:
+            self._outputs.remove(output)
+            if task is not None:
+                self.stop()
+                await task
+
+    async def _read_loop(self, follower, queue):
+        loop = asyncio.get_running_loop()
+        while not self._stopping.is_set():
+            lines = follower.read_lines()
+            if len(lines) == 0:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.lines_read_ += len(lines)
+            self.queue_depth_ += len(lines)
+            self.max_queue_depth_ = max(self.max_queue_depth_, self.queue_depth_)
+            await queue.put((loop.time(), follower.path, lines))
+
+    async def _score_loop(self, queue):
+        loop = asyncio.get_running_loop()
+        lines, sources, times = [], [], []
+        done = False
+        while not done:
+            timeout = None
+            if len(lines) > 0:
+                timeout = max(times[0] + self.flush_interval - loop.time(), 0)
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                item = ()
+            if item is None:
+                done = True
+            elif len(item) > 0:
+                read_time, path, new_lines = item
+                lines.extend(new_lines)
+                sources.extend([path] * len(new_lines))
+                times.extend([read_time] * len(new_lines))
+            #Flushing full batches, and the rest on timeout or stop
+            flush_all = done or len(item) == 0
+            while len(lines) >= self.batch_size or (flush_all and len(lines) > 0):
+                size = min(len(lines), self.batch_size)
+                await self._flush(lines[:size], sources[:size], times[0])
+                del lines[:size], sources[:size], times[:size]
+
+    async def _flush(self, lines, sources, read_time):
+        loop = asyncio.get_running_loop()
+        offset = self.lines_scored_
+        #Parsing and scoring in a thread, so that files are still polled
+        anomalies = await loop.run_in_executor(None, self._score, lines, sources, offset)
+        self.queue_depth_ -= len(lines)
+        self.lines_scored_ += len(lines)
+        self.batches_ += 1
+        if len(anomalies) > 0:
+            self.anomalies_ += len(anomalies)
+            if self.callback is not None:
+                result = self.callback(anomalies)
+                if asyncio.iscoroutine(result):
+                    await result
+            for output in self._outputs:
+                output.put_nowait(anomalies)
+        latency = loop.time() - read_time
+        self.last_batch_latency_ = latency
+        self.total_batch_latency_ += latency
+        self.max_batch_latency_ = max(self.max_batch_latency_, latency)
+        logging.info('RequestLogFollower: Scored %d lines in %.3fs, %d queued',
+                     len(lines), latency, self.queue_depth_)
+
+    def _parse(self, lines):
+        """Parses the lines, dropping (and counting) those which do not
+        match the log format. Returns the DataFrame and the kept lines."""
+        kept = list(range(len(lines)))
+        regex = _LOG_REGEXES.get(self.log_format)
+        if regex is not None:
+            #One vectorized match of the batch, instead of a parse per line
+            matched = pd.Series(lines, dtype=object).str.match(regex.pattern).to_numpy()
+            kept = [i for i in kept if matched[i]]
+            self.lines_skipped_ += len(lines) - len(kept)
+            lines = [lines[i] for i in kept]
+        try:
+            return preprocess_requests(lines, self.log_format), kept
+        except (LineDoesntMatchException, ValueError):
+            pass
+        #Rare: invalid timestamps, or Apache LogFormat strings
+        parsed, parsed_kept = [], []
+        for i, line in zip(kept, lines):
+            try:
+                parsed.append(preprocess_requests([line], self.log_format))
+                parsed_kept.append(i)
+            except (LineDoesntMatchException, ValueError):
+                self.lines_skipped_ += 1
+        if len(parsed) == 0:
+            return preprocess_requests([], self.log_format), parsed_kept
+        return pd.concat(parsed, ignore_index=True), parsed_kept
+
+    def _score(self, lines, sources, offset):
+        """Anomalous requests among lines (bytes), indexed by their position
+        in the stream of scored lines."""
+        with self.detector.profile_stage("parse", len(lines)):
+            X, kept = self._parse([line.decode(self.encoding, errors="replace")
+                                   for line in lines])
+        X.index = pd.Index(kept) + offset
+        if len(X) == 0:
+            return X
+        scores = self.detector.score_matrix(X)
+        anomalous = self.detector.decision_function(X, scores) < 0
+        anomalies = pd.concat([X[anomalous], self.detector.score_frame(
+            scores[anomalous], X.index[anomalous])], axis=1)
+        anomalies["source"] = [sources[i - offset] for i in anomalies.index]
+        return anomalies
@@ -0,0 +1,109 @@
+"""
+Tests for the real-time log follower.
+"""
+import asyncio
+import os
+import pandas as pd
+from timeit import default_timer as timer
+from ..classes import preprocess_requests
+from ..classes import RequestAnomalyDetector
+from ..follow import RequestLogFollower
+
+ACCESS_LOG = os.path.join(os.path.dirname(__file__), "access.log")
+
+async def _wait_until(condition, timeout=10):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("Timeout waiting for the follower")
+
+def test_log_follower(tmp_path):
+    """New lines are scored across rotations and truncations
+    """
+    with open(ACCESS_LOG, 'rb') as f:
+        lines = f.readlines()
+    ad = RequestAnomalyDetector(cache_size=1000).fit(
+        preprocess_requests([line.decode() for line in lines[:4000]], "Combined"))
+    new_lines = lines[4000:5100]
+    X = preprocess_requests([line.decode() for line in new_lines], "Combined")
+    results = ad.predict(X)
+    expected = ((results["pvalue"] < 0.01) | (results.drop(columns="pvalue") > 0).any(axis=1))
+
+    log = tmp_path / "access_log"
+    log.write_bytes(b"".join(lines[:100]))
+    received = []
+    follower = RequestLogFollower(ad, str(log), callback=received.append,
+                                  batch_size=300, flush_interval=0.05, poll_interval=0.01)
+
+    async def main():
+        task = asyncio.ensure_future(follower.run())
+        await asyncio.sleep(0.05)
+        with open(str(log), 'ab') as f:
+            f.write(b"".join(new_lines[:500]))
+        await _wait_until(lambda: follower.lines_read_ == 500)
+        #Rotation, the new file is read from its start
+        os.rename(str(log), str(tmp_path / "access_log.1"))
+        log.write_bytes(b"".join(new_lines[500:1000]) + b"not a log line\n")
+        await _wait_until(lambda: follower.lines_read_ == 1001)
+        #Truncation
+        log.write_bytes(b"".join(new_lines[1000:]))
+        await _wait_until(lambda: follower.lines_scored_ == 1101)
+        follower.stop()
+        await task
+    asyncio.run(main())
+
+    metrics = follower.metrics()
+    assert metrics["lines_skipped"] == 1
+    assert metrics["rotations"] == 1
+    assert metrics["truncations"] == 1
+    assert metrics["queue_depth"] == 0
+    assert metrics["anomalies"] == expected.sum()
+    assert 0 < metrics["max_batch_latency"] < 1
+    anomalies = pd.concat(received)
+    assert list(anomalies["request_url"]) == list(X["request_url"][expected.to_numpy()])
+    assert (anomalies["source"] == str(log)).all()
+
+def test_log_follower_iterator(tmp_path):
+    """Anomalies can be consumed with async for
+    """
+    with open(ACCESS_LOG, 'rb') as f:
+        lines = f.readlines()
+    ad = RequestAnomalyDetector(alpha=0.2).fit(
+        preprocess_requests([line.decode() for line in lines[:100]], "Combined"))
+    X = preprocess_requests([line.decode() for line in lines[100:1000]], "Combined")
+    log = tmp_path / "access_log"
+    log.write_bytes(b"".join(lines[100:1000]))
+    follower = RequestLogFollower(ad, [str(log)], from_start=True, flush_interval=0.01)
+
+    async def main():
+        count = 0
+        async for anomalies in follower:
+            count += len(anomalies)
+            if follower.lines_scored_ == 900:
+                follower.stop()
+        return count
+    #Anomalies are the requests with negative decision_function
+    assert asyncio.run(main()) == follower.metrics()["anomalies"] == \
+        (ad.decision_function(X) < 0).sum()
+
+def test_log_follower_bad_lines():
+    """A line that does not match does not slow down its batch
+    """
+    with open(ACCESS_LOG) as f:
+        lines = f.readlines()[:5000]
+    ad = RequestAnomalyDetector().fit(preprocess_requests(lines[:100], "Combined"))
+    follower = RequestLogFollower(ad, [])
+    batch = lines[:2500] + ["garbage\n"] + lines[2500:]
+    start = timer()
+    X, kept = follower._parse(batch)
+    assert timer() - start < 1
+    assert X.equals(preprocess_requests(lines, "Combined"))
+    assert kept == list(range(2500)) + list(range(2501, 5001))
+    assert follower.lines_skipped_ == 1
+    #Lines matching the format but with an invalid timestamp
+    bad_time = lines[0].replace("[", "[99/", 1)
+    X, kept = follower._parse(lines[:10] + [bad_time] + ["garbage\n"] + lines[10:20])
+    assert kept == list(range(10)) + list(range(12, 22))
+    assert X.equals(preprocess_requests(lines[:20], "Combined"))
+    assert follower.lines_skipped_ == 3
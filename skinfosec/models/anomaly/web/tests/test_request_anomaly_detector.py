@@ -1,8 +1,26 @@
 """
 Tests for the request anomaly detection model.
 """
+import bz2
+import gzip
+import os
+import tarfile
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import chisquare
 from ..classes import preprocess_requests
+from ..classes import preprocess_requests_chunks
+from ..classes import preprocess_requests_parallel
+from ..classes import open_request_logs
 from ..classes import RequestAnomalyDetector
+from ..classes import RequestFeatureExtractor
+from ..classes import RequestFeatureVectorizer
+from ..classes import normalize_paths
+from ..classes import summarize_requests, combine_summaries
+from ..classes import _encode_urls, _char_count_bins, _chisquare_pvalues
+
+ACCESS_LOG = os.path.join(os.path.dirname(__file__), "access.log")
 
 def test_preprocess_requests():
     """Tests with a simple CLF log
@@ -33,3 +51,364 @@ def test_anomaly_detector():
     anomalies = ad.predict(X)
     print(anomalies["uri_length"].head())
     assert False
+
+def test_char_count_bins():
+    """Batched character histograms match per character counting
+    """
+    urls = ["/index.php?id=1&id=2", "", "/a\u00e9\u20ac/%20", "*"]
+    codes, lengths = _encode_urls(urls)
+    bins = _char_count_bins(codes, lengths)
+    for url, row in zip(urls, bins):
+        counts = sorted([url.count(chr(i)) for i in range(256)], reverse=True)
+        expected = [counts[0], sum(counts[1:4]), sum(counts[4:7]),
+                    sum(counts[7:12]), sum(counts[12:16]), sum(counts[16:])]
+        assert np.array_equal(row, expected)
+
+def test_chisquare_pvalues():
+    """Batched chi-square p-values match scipy.stats.chisquare
+    """
+    icd = [0.3, 0.25, 0.2, 0.1, 0.1, 0.05]
+    urls = ["/index.php?id=1&id=2", "", "/images/logo.png", "*"]
+    codes, lengths = _encode_urls(urls)
+    bins = _char_count_bins(codes, lengths)
+    pvalues = _chisquare_pvalues(bins, lengths, icd)
+    assert pvalues[1] == 0.0
+    for i in (0, 2, 3):
+        expected = chisquare(bins[i], [v*lengths[i] for v in icd]).pvalue
+        assert np.isclose(pvalues[i], expected)
+
+def test_param_models():
+    """Sets and lists of parameters are counted and checked
+    """
+    train = pd.DataFrame({"request_url": ["/s?q=1&p=2", "/s?p=2&q=1", "/s?q=3&p=1",
+                                          "/login?user=a"]})
+    ad = RequestAnomalyDetector().fit(train)
+    assert ad.attribute_models_["param_sets"][frozenset(["p", "q"])] == 3
+    assert ad.attribute_models_["param_lists"][("q", "p")] == 2
+    test = pd.DataFrame({"request_url": ["/s?p=1&q=2", "/s?q=1&x=2", "/login?user=b"]})
+    anomalies = ad.predict(test)
+    assert anomalies["param_sets"].tolist() == [0, 1, 0]
+    assert anomalies["param_lists"].tolist() == [0, 1, 0]
+    ad = RequestAnomalyDetector(min_param_count=2).fit(train)
+    anomalies = ad.predict(test)
+    assert anomalies["param_sets"].tolist() == [0, 1, 1]
+    assert anomalies["param_lists"].tolist() == [1, 1, 1]
+
+def test_request_feature_extractor():
+    """URLs are decomposed in path, parameters and lengths
+    """
+    X = pd.DataFrame({"request_url": ["/s?q=1&p=&q=2", "*"]}, index=[5, 7])
+    features = RequestFeatureExtractor().fit_transform(X)
+    assert features.index.tolist() == [5, 7]
+    assert features.loc[5, "path"] == "/s"
+    assert features.loc[5, "length"] == 13
+    assert features.loc[5, "param_list"] == ("q", "q")
+    assert features.loc[5, "param_values"] == ("1", "2")
+    assert features.loc[5, "param_set"] == frozenset(["q"])
+    assert features.loc[7, "param_list"] == ()
+    assert features.loc[7, "param_set"] == frozenset()
+
+def test_preprocess_requests_engines():
+    """The regex engine returns the same data as apache_log_parser
+    """
+    lines = ['127.0.0.1 - frank [10/Oct/2000:13:55:36 -0700] "GET /a.gif?x=1 HTTP/1.0" '
+             '200 2326 "http://example.com/" "Mozilla/4.08"\n',
+             '10.0.0.2 - - [10/Oct/2000:22:55:36 +0200] "-" 408 - "-" "-"\n',
+             '10.0.0.3 - - [10/Oct/2000:20:55:37 +0000] "OPTIONS *" 200 - "-" "-"\n']
+    for log_format in ("CLF", "Combined"):
+        X = preprocess_requests(lines, log_format)
+        Y = preprocess_requests(lines, log_format, engine="apache_log_parser")
+        assert list(X.columns) == list(Y.columns)
+        assert X.request_url.tolist() == ["/a.gif?x=1", "", "*"]
+        assert X.request_http_ver.tolist()[:2] == ["1.0", ""]
+        assert X.request_http_ver.isna()[2]
+        assert X.status.tolist() == Y.status.tolist()
+        assert X.response_bytes_clf.tolist() == ["2326", "-", "-"]
+        assert (X.time_received_tz_datetimeobj ==
+                pd.to_datetime(Y.time_received_tz_datetimeobj, utc=True)).all()
+    assert X.request_header_user_agent[0] == "Mozilla/4.08"
+
+def test_chunked_fit():
+    """Fitting over chunks gives the same model as a single fit
+    """
+    with open(ACCESS_LOG) as f:
+        chunks = list(preprocess_requests_chunks(f, "Combined", chunksize=1000))
+    assert [len(chunk) for chunk in chunks] == [1000]*5 + [484]
+    assert chunks[-1].index[0] == 5000
+    with open(ACCESS_LOG) as f:
+        X = preprocess_requests(f, "Combined")
+    full = RequestAnomalyDetector().fit(X).attribute_models_
+    chunked = RequestAnomalyDetector().fit(iter(chunks)).attribute_models_
+    assert np.allclose(full["uri_length"], chunked["uri_length"])
+    assert np.allclose(full["icd"], chunked["icd"])
+    assert full["param_sets"] == chunked["param_sets"]
+    assert full["param_lists"] == chunked["param_lists"]
+
+def test_partial_fit():
+    """Incremental training gives the same model as a fit over all the data
+    """
+    with open(ACCESS_LOG) as f:
+        X = preprocess_requests(f, "Combined")
+    full = RequestAnomalyDetector().fit(X)
+    ad = RequestAnomalyDetector()
+    for start in range(0, len(X), 700):
+        ad = ad.partial_fit(X.iloc[start:start + 700])
+    assert ad.stats_.count == len(X)
+    assert np.allclose(full.attribute_models_["uri_length"],
+                       ad.attribute_models_["uri_length"])
+    assert np.allclose(full.attribute_models_["icd"], ad.attribute_models_["icd"])
+    assert full.attribute_models_["param_sets"] == ad.attribute_models_["param_sets"]
+    assert full.attribute_models_["param_lists"] == ad.attribute_models_["param_lists"]
+    assert np.allclose(full.predict(X), ad.predict(X))
+
+def test_preprocess_requests_parallel():
+    """Parsing byte ranges in several processes keeps lines and order
+    """
+    with open(ACCESS_LOG) as f:
+        X = preprocess_requests(f, "Combined")
+    Y = preprocess_requests_parallel(ACCESS_LOG, "Combined", n_jobs=3)
+    assert Y.index.equals(X.index)
+    assert X.equals(Y)
+
+def test_compressed_rotated_logs(tmp_path):
+    """Rotated, compressed and archived logs are read in place, oldest first
+    """
+    with open(ACCESS_LOG, 'rb') as f:
+        lines = f.readlines()
+    X = preprocess_requests([line.decode() for line in lines], "Combined")
+    #access_log.3 holds the oldest lines
+    parts = [b"".join(lines[:1000]), b"".join(lines[1000:2500]),
+             b"".join(lines[2500:4000]), b"".join(lines[4000:])]
+    with gzip.open(str(tmp_path / "access_log.3.gz"), 'wb') as f:
+        f.write(parts[0])
+    with bz2.open(str(tmp_path / "access_log.2.bz2"), 'wb') as f:
+        f.write(parts[1])
+    (tmp_path / "access_log.1").write_bytes(parts[2])
+    (tmp_path / "access_log").write_bytes(parts[3])
+    Y = preprocess_requests_parallel(str(tmp_path / "access_log*"), "Combined", n_jobs=2)
+    assert X.equals(Y)
+    Y = preprocess_requests(open_request_logs(str(tmp_path / "access_log*")), "Combined")
+    assert X.equals(Y)
+
+    #Same files in a tar archive, added in a different order
+    archive = str(tmp_path / "logs.tar.gz")
+    with tarfile.open(archive, "w:gz") as tar:
+        for name in ["access_log", "access_log.1", "access_log.3.gz", "access_log.2.bz2"]:
+            tar.add(str(tmp_path / name), arcname="var/log/httpd/" + name)
+        tar.add(ACCESS_LOG, arcname="var/log/other.log")
+    for n_jobs in [1, 2]:
+        Y = preprocess_requests_parallel(archive, "Combined", n_jobs=n_jobs,
+                                         members="var/log/httpd/access_log*")
+        assert X.equals(Y)
+    Y = preprocess_requests(open_request_logs(archive, members="var/log/httpd/*"),
+                            "Combined")
+    assert X.equals(Y)
+
+def test_sharded_fit():
+    """Merged summaries of disjoint shards give the same model as a global fit
+    """
+    with open(ACCESS_LOG) as f:
+        X = preprocess_requests(f, "Combined")
+    full = RequestAnomalyDetector().fit(X).attribute_models_
+    summary = combine_summaries(summarize_requests(X.iloc[i::3]) for i in range(3))
+    assert summary.count == len(X)
+    sharded = RequestAnomalyDetector().fit_summary(summary).attribute_models_
+    parallel = RequestAnomalyDetector(n_jobs=2).fit(X).attribute_models_
+    for models in (sharded, parallel):
+        assert np.allclose(full["uri_length"], models["uri_length"])
+        assert np.allclose(full["icd"], models["icd"])
+        assert full["param_sets"] == models["param_sets"]
+        assert full["param_lists"] == models["param_lists"]
+
+def test_normalize_paths():
+    """Endpoints collapse slashes and numeric segments
+    """
+    paths = pd.Series(["/entry/15205", "//a//b/", "/", "*", "/v2/items/7/edit"])
+    assert normalize_paths(paths).tolist() == ["/entry/{id}", "/a/b", "/", "*",
+                                                "/v2/items/{id}/edit"]
+
+def test_path_models():
+    """Requests are checked against the models of their endpoint
+    """
+    train = pd.DataFrame({"request_url":
+                          ["/login?u=%d" % i for i in range(20)] +
+                          ["/search?q=" + "x"*(i % 7 + 40) for i in range(20)] +
+                          ["/rare?z=1"]})
+    test = pd.DataFrame({"request_url": ["/login?u=" + "y"*25, "/rare?z=1&w=2",
+                                         "/search?q=" + "x"*42]})
+    ad = RequestAnomalyDetector().fit(train)
+    assert ad.predict(test)["uri_length"].tolist() == [0, 0, 0]
+    ad = RequestAnomalyDetector(max_paths=2, min_path_count=5).fit(train)
+    assert set(ad.attribute_models_["paths"]) == {"/login", "/search"}
+    anomalies = ad.predict(test)
+    assert anomalies["uri_length"].tolist() == [1, 0, 0]
+    assert anomalies["param_sets"].tolist() == [0, 1, 0]
+    chunked = RequestAnomalyDetector(max_paths=2, min_path_count=5)
+    chunked = chunked.fit(train.iloc[i:i + 10] for i in range(0, len(train), 10))
+    assert np.allclose(chunked.predict(test), anomalies, equal_nan=True)
+
+def test_path_models_cap():
+    """Only the endpoints admitted by max_paths are summarized
+    """
+    words = ["".join(chr(97 + int(c)) for c in str(i)) for i in range(30)]
+    X = pd.DataFrame({"request_url": ["/%s/x?a=%d" % (words[i % 30], i) + "b" * (i % 5)
+                                      for i in range(300)]})
+    summary = summarize_requests(X, max_paths=10)
+    assert list(summary.paths) == ["/%s/x" % word for word in words[:10]]
+    for i, (endpoint, child) in enumerate(summary.paths.items()):
+        assert len(child.paths) == 0
+        expected = summarize_requests(X.iloc[i::30])
+        assert child.count == expected.count
+        assert np.allclose([child.length_mean, child.length_m2],
+                           [expected.length_mean, expected.length_m2])
+        assert np.allclose(child.char_freq, expected.char_freq)
+        assert child.param_sets == expected.param_sets
+    #Tracked endpoints keep being updated, new ones are not admitted
+    summary.update(RequestFeatureExtractor().transform(X.iloc[::-1]))
+    assert len(summary.paths) == 10
+    assert all(child.count == 20 for child in summary.paths.values())
+    assert summary.count == 600
+
+def test_score_cache():
+    """Cached and deduplicated results match a plain predict
+    """
+    with open(ACCESS_LOG) as f:
+        X = preprocess_requests(f, "Combined")
+    ad = RequestAnomalyDetector().fit(X)
+    expected = ad.predict(X)
+    assert ad.predict(X.iloc[:0]).shape == (0, 4)
+    ad = RequestAnomalyDetector(cache_size=10).fit(X)
+    for start in range(0, len(X), 500):
+        result = ad.predict(X.iloc[start:start + 500])
+        assert np.allclose(result, expected.iloc[start:start + 500])
+    info = ad.cache_info()
+    assert info.hits + info.misses == X["request_url"].groupby(X.index // 500).nunique().sum()
+    assert info.hits > 0 and info.currsize == 10
+    ad.partial_fit(X.iloc[:10])
+    assert ad.cache_info() == (0, 0, 10, 0)
+
+def test_preprocess_requests_typed():
+    """Typed output uses compact dtypes and keeps the values
+    """
+    with open(ACCESS_LOG) as f:
+        lines = f.readlines()
+    X = preprocess_requests(lines, "Combined")
+    for engine in ("regex", "apache_log_parser"):
+        Y = preprocess_requests(lines, "Combined", engine=engine, typed=True)
+        assert Y.remote_host.dtype == "category"
+        assert Y.request_header_user_agent.dtype == "category"
+        assert Y.status.dtype == "Int16"
+        assert Y.response_bytes_clf.dtype == "Int64"
+        assert (Y.status.astype(str) == X.status).all()
+        assert Y.response_bytes_clf.isna().sum() == (X.response_bytes_clf == "-").sum()
+        assert (Y.time_received_tz_datetimeobj == X.time_received_tz_datetimeobj).all()
+        assert Y.request_url.tolist() == X.request_url.tolist()
+    Y = preprocess_requests(lines, "Combined", typed=True)
+    assert Y.memory_usage(deep=True).sum() < X.memory_usage(deep=True).sum() / 2
+    Z = preprocess_requests_parallel(ACCESS_LOG, "Combined", n_jobs=2, typed=True)
+    assert Z.equals(Y)
+
+def test_clustering_stage():
+    """Clusters are fitted once and assigned to new batches incrementally
+    """
+    with open(ACCESS_LOG) as f:
+        X = preprocess_requests(f, "Combined")
+    ad = RequestAnomalyDetector(n_clusters=3, random_state=0,
+                                store_predict_results=True).fit(X)
+    ad.predict(X)
+    labels = ad.kmeans()
+    assert len(labels) == len(X) and len(np.unique(labels)) == 3
+    assert (ad.predict_clusters(X) == labels).all()
+    assert (ad.kmeans(X) == labels).all()
+
+    ad = RequestAnomalyDetector(n_clusters=3, cluster_batch_size=256, random_state=0).fit(X)
+    ad.predict(X)
+    assert ad.predict_results_ is None
+    try:
+        ad.kmeans()
+        assert False
+    except ValueError:
+        pass
+    for start in range(0, len(X), 1000):
+        ad.partial_fit_clusters(X.iloc[start:start + 1000])
+    assert ad.clusterer_.cluster_centers_.shape == (3, 4)
+    assert len(ad.predict_clusters(X.iloc[:100])) == 100
+
+def test_profiling():
+    """Stages are recorded only while profiling is enabled
+    """
+    with open(ACCESS_LOG) as f:
+        lines = f.readlines()
+    ad = RequestAnomalyDetector()
+    ad.fit(preprocess_requests(lines, "Combined"))
+    assert ad.profile_summary() == {}
+
+    records = []
+    ad.enable_profiling(trace_memory=True)
+    ad.add_profile_callback(records.append)
+    with ad.profile_stage("parse") as stage:
+        X = preprocess_requests(lines, "Combined")
+        stage.rows = len(X)
+    ad.fit(X)
+    ad.predict(X)
+    ad.kmeans(X)
+    summary = ad.disable_profiling()
+    assert set(summary) == {"parse", "fit", "features", "length", "char-distribution",
+                            "params", "predict", "chi-square", "clustering"}
+    assert summary["parse"]["rows"] == summary["fit"]["rows"] == len(X)
+    #Distinct URLs, scored by predict and kmeans
+    assert summary["chi-square"]["rows"] == 2 * X["request_url"].nunique()
+    assert summary["fit"]["wall_time"] >= summary["char-distribution"]["wall_time"] > 0
+    assert summary["parse"]["rows_per_second"] > 0
+    assert summary["parse"]["peak_memory"] > 0
+    assert len(records) == sum(stats["calls"] for stats in summary.values())
+    assert ad.profile_summary() == {}
+
+def test_request_feature_vectorizer():
+    """Sparse features hash parameter names and order, and keep ICD, length and status
+    """
+    X = pd.DataFrame({"request_url": ["/a?x=1&y=2", "/a?y=2&x=1", "/b", ""],
+                      "status": ["200", "404", "-", "301"]})
+    vectorizer = RequestFeatureVectorizer(n_param_features=16, n_order_features=16)
+    M = vectorizer.fit_transform(X)
+    assert M.format == "csr" and M.shape == (4, 16 + 16 + 7 + 5)
+    assert len(vectorizer.get_feature_names_out()) == M.shape[1]
+    dense = M.toarray()
+    #Same parameter names, different order
+    assert (dense[0, :16] == dense[1, :16]).all() and dense[0, :16].sum() == 2
+    assert (dense[0, 16:32] != dense[1, 16:32]).any() and dense[0, 16:32].sum() == 2
+    assert dense[2, :32].sum() == 0
+    assert np.allclose(dense[:3, 32:38].sum(axis=1), 1) and dense[3, 32:38].sum() == 0
+    assert (dense[:, 38] == X["request_url"].str.len()).all()
+    assert (dense[:, 39:] == [[0, 1, 0, 0, 0], [0, 0, 0, 1, 0],
+                              [0, 0, 0, 0, 0], [0, 0, 1, 0, 0]]).all()
+    with open(ACCESS_LOG) as f:
+        X = preprocess_requests(f, "Combined", typed=True)
+    M = RequestFeatureVectorizer(status=False).transform(X)
+    assert M.shape == (len(X), 1024 + 1024 + 7)
+
+def test_score_matrix():
+    """Scores are arrays, predict wraps them and nothing is kept in the model
+    """
+    with open(ACCESS_LOG) as f:
+        X = preprocess_requests(f, "Combined")
+    ad = RequestAnomalyDetector(max_paths=50).fit(X.iloc[:3000])
+    result = ad.predict(X)
+    scores = ad.score_matrix(X)
+    assert scores.shape == (len(X), 4)
+    assert np.array_equal(result.to_numpy(), scores, equal_nan=True)
+    assert list(result.columns) == ["uri_length", "pvalue", "param_sets", "param_lists"]
+    assert result["uri_length"].dtype == int and result.index.equals(X.index)
+    assert ad.score_matrix(X, as_frame=True).equals(result)
+    assert set(ad.attribute_models_) == {"uri_length", "icd", "param_sets",
+                                         "param_lists", "paths"}
+    decision = ad.decision_function(X)
+    anomalous = (result["pvalue"] < 0.01) | (result.drop(columns="pvalue") > 0).any(axis=1)
+    assert np.array_equal(decision < 0, anomalous.to_numpy())
+    assert np.allclose(ad.score_samples(X), decision + 0.01)
+    assert np.array_equal(ad.decision_function(X, scores), decision)
+    #Not fitted
+    ad = RequestAnomalyDetector()
+    assert ad.predict(X) is None
+    with pytest.raises(ValueError):
+        ad.score_matrix(X)